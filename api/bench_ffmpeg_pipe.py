@@ -0,0 +1,60 @@
+'''
+usage: python3 bench_ffmpeg_pipe.py [number of frames] [width] [height]
+i.e.: python3 bench_ffmpeg_pipe.py 200 512 512
+
+compares piping PNG images (image2pipe) with piping decoded raw frames (rawvideo) to ffmpeg,
+as done by img2vid.py and vid2vid_ffmpeg.py depending on RAW_FRAMES
+
+no backend needed, frames are generated locally
+
+Needs vid2vid_ffmpeg.py next to it.
+Needs ffmpeg.
+'''
+import sys
+import tempfile
+import time
+from io import BytesIO
+from pathlib import Path
+
+import numpy as np
+import vid2vid_ffmpeg
+from PIL import Image
+
+
+def make_frames(count: int, width: int, height: int):
+    '''PNG encoded test frames, similar to what the API returns'''
+    rng = np.random.default_rng(0)
+    gradient = np.linspace(0, 255, width, dtype=np.uint8)[None, :, None]
+    for i in range(count):
+        frame = gradient + rng.integers(0, 32, (height, width, 3), dtype=np.uint8) + np.uint8(i % 256)
+        with Image.fromarray(frame, mode="RGB") as image, BytesIO() as buffer:
+            image.save(buffer, "PNG")
+            yield buffer.getvalue()
+
+
+def run(images: list, output_file: str, frame_size: tuple = None):
+    start = time.perf_counter()
+    with vid2vid_ffmpeg.prepare_output(output_file, 24, frame_size) as output:
+        for image in images:
+            output.write(image if frame_size is None else vid2vid_ffmpeg.decode_frame(image))
+    return time.perf_counter() - start
+
+
+def main(count=200, width=512, height=512):
+    count, width, height = int(count), int(width), int(height)
+    images = list(make_frames(count, width, height))
+
+    with tempfile.TemporaryDirectory() as directory:
+        png_time = run(images, str(Path(directory, "png.mp4")))
+        raw_time = run(images, str(Path(directory, "raw.mp4")), (width, height))
+
+    print(f"{count} frames, {width}x{height}")
+    print(f"image2pipe: {png_time:.2f}s ({count / png_time:.1f} fps)")
+    print(f"rawvideo:   {raw_time:.2f}s ({count / raw_time:.1f} fps)")
+
+
+if __name__ == "__main__":
+    try:
+        main(*sys.argv[1:4])
+    except TypeError as error:
+        print(str(error))
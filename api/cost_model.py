@@ -0,0 +1,111 @@
+'''
+job cost model and cost-ordered job queue, used by img2img.py with COST_HISTORY set
+
+predicts the backend time of a job from its payload (steps, image size, batch size, ControlNet units)
+and a per-server speed learned from previous runs, kept in a JSON file between runs.
+
+jobs are handed out longest first, so the big ones don't end up as a long tail at the end of a run.
+a server is given the shortest job instead, if another server is predicted to finish the longest one sooner.
+'''
+import asyncio
+import bisect
+import json
+import time
+from pathlib import Path
+
+# Extra cost of each ControlNet unit, relative to the image generation itself
+CONTROLNET_COST = 0.4
+
+# Weight of a new measurement in a server's speed
+LEARNING_RATE = 0.2
+
+# Seconds per cost unit of a server without history
+DEFAULT_SPEED = 1.0
+
+
+def job_units(payload: dict) -> float:
+    '''cost of a job in units of one sampling step at 512x512'''
+    steps = payload.get("steps", 20)
+    if "init_images" in payload:
+        # img2img only runs the denoised part of the steps
+        steps *= payload.get("denoising_strength", 0.75)
+
+    pixels = payload.get("width", 512) * payload.get("height", 512) / (512 * 512)
+    images = payload.get("batch_size", 1) * payload.get("n_iter", 1)
+    controlnet_units = len(payload.get("alwayson_scripts", {}).get("controlnet", {}).get("args", []))
+    return max(steps, 1) * pixels * images * (1 + CONTROLNET_COST * controlnet_units)
+
+
+class CostModel:
+    '''per-server speeds (seconds per cost unit), loaded from and saved to a JSON file'''
+
+    def __init__(self, history_file):
+        self.history_file = Path(history_file)
+        self.speeds = json.loads(self.history_file.read_text()) if self.history_file.exists() else {}
+        # (predicted, actual) seconds of the jobs of this run
+        self.results = []
+
+    def predict(self, units: float, server_address: str) -> float:
+        return units * self.speeds.get(server_address, DEFAULT_SPEED)
+
+    def record(self, units: float, server_address: str, seconds: float):
+        '''learn from a finished job'''
+        self.results.append((self.predict(units, server_address), seconds))
+        speed = seconds / units
+        if server_address in self.speeds:
+            speed = self.speeds[server_address] * (1 - LEARNING_RATE) + speed * LEARNING_RATE
+        self.speeds[server_address] = speed
+
+    def save(self):
+        self.history_file.write_text(json.dumps(self.speeds, indent=2))
+
+    def makespan(self, units: list, servers: list) -> float:
+        '''predicted duration of a run, handing out jobs longest first to the server finishing first'''
+        free_at = {server_address: 0.0 for server_address in servers}
+        for job in sorted(units, reverse=True):
+            server_address = min(free_at, key=lambda s: free_at[s] + self.predict(job, s))
+            free_at[server_address] += self.predict(job, server_address)
+        return max(free_at.values(), default=0.0)
+
+    def drift(self) -> float:
+        '''mean relative deviation of actual job times from the predictions of this run'''
+        if not self.results:
+            return 0.0
+        return sum(abs(actual - predicted) / predicted for predicted, actual in self.results) / len(self.results)
+
+
+class CostQueue(asyncio.Queue):
+    '''queue of (units, job) items, handing out the most expensive job first'''
+
+    def __init__(self, cost_model: CostModel, servers: list):
+        super().__init__()
+        self.cost_model = cost_model
+        # predicted time each server is busy until
+        self.busy_until = {server_address: 0.0 for server_address in servers}
+
+    def _init(self, maxsize):
+        self._queue = []
+
+    def _put(self, item):
+        bisect.insort(self._queue, item, key=lambda queued: queued[0])
+
+    def _get(self):
+        return self._queue.pop()
+
+    async def get_for(self, server_address: str):
+        '''next (units, job) item for a server'''
+        item = await self.get()
+        units = item[0]
+        now = time.monotonic()
+
+        # leave the longest job to another server, if that one will finish it sooner
+        finish_here = now + self.cost_model.predict(units, server_address)
+        finish_elsewhere = min((max(now, busy_until) + self.cost_model.predict(units, other)
+                                for other, busy_until in self.busy_until.items() if other != server_address),
+                               default=finish_here)
+        if finish_elsewhere < finish_here and self._queue:
+            self._put(item)
+            item = self._queue.pop(0)
+
+        self.busy_until[server_address] = now + self.cost_model.predict(item[0], server_address)
+        return item
@@ -0,0 +1,95 @@
+'''
+perceptual near-duplicate detection, used by interrogate.py with DEDUPLICATE set
+
+computes a difference hash (dHash) of every image in a process pool
+and groups images whose hashes differ in at most a few bits, using a BK-tree.
+resized or recompressed copies of an image end up in the same cluster.
+'''
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from PIL import Image
+
+# Size of the hash is HASH_SIZE * HASH_SIZE bits
+HASH_SIZE = 8
+
+
+def dhash(filename: Path):
+    '''difference hash of an image, None if it can't be read'''
+    try:
+        with Image.open(filename) as image:
+            image.draft("L", (HASH_SIZE * 4, HASH_SIZE * 4))
+            small = image.convert("L").resize((HASH_SIZE + 1, HASH_SIZE), Image.LANCZOS)
+    except Exception:
+        return None
+
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(HASH_SIZE):
+        for col in range(HASH_SIZE):
+            left = pixels[row * (HASH_SIZE + 1) + col]
+            right = pixels[row * (HASH_SIZE + 1) + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def distance(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+class BKTree:
+    '''metric tree over hashes, finds all hashes within a hamming distance'''
+
+    def __init__(self):
+        self.root = None
+
+    def add(self, value: int, item):
+        node = self.root
+        if node is None:
+            self.root = (value, item, {})
+            return
+
+        while True:
+            node_value, _, children = node
+            d = distance(value, node_value)
+            if d not in children:
+                children[d] = (value, item, {})
+                return
+            node = children[d]
+
+    def find(self, value: int, max_distance: int):
+        '''item of the closest node within max_distance, None if there is none'''
+        best, best_distance = None, max_distance + 1
+        nodes = [self.root] if self.root is not None else []
+        while nodes:
+            node_value, item, children = nodes.pop()
+            d = distance(value, node_value)
+            if d < best_distance:
+                best, best_distance = item, d
+            # the triangle inequality limits the subtrees worth looking into
+            nodes.extend(child for key, child in children.items()
+                         if d - max_distance <= key <= d + max_distance)
+        return best
+
+
+def find_clusters(filenames: list, max_distance: int) -> dict:
+    '''group near-duplicate files, returns {representative: [other members]}'''
+    with ProcessPoolExecutor() as executor:
+        hashes = list(executor.map(dhash, filenames, chunksize=32))
+
+    tree = BKTree()
+    clusters = {}
+    for filename, value in zip(filenames, hashes):
+        if value is None:
+            # unreadable files are left to the backend to complain about
+            clusters[filename] = []
+            continue
+
+        representative = tree.find(value, max_distance)
+        if representative is None:
+            tree.add(value, filename)
+            clusters[filename] = []
+        else:
+            clusters[representative].append(filename)
+
+    return clusters
@@ -0,0 +1,76 @@
+'''
+on-disk store for generated video frames, used by img2vid.py and vid2vid_ffmpeg.py
+
+every frame is saved as <frame index>.<extension> as soon as it arrives,
+so an interrupted run only has to generate the missing frames when started again.
+with all frames in the store, a run only re-encodes the video (i.e. with different ffmpeg filters).
+
+a manifest ties the store to the input and generation parameters it was created for,
+a store created for anything else is refused instead of silently mixing in its frames.
+'''
+import json
+import os
+from pathlib import Path
+
+JPG_SIG = bytes.fromhex("ff d8 ff")
+PNG_SIG = bytes.fromhex("89 50  4e  47  0d  0a  1a  0a")
+
+MANIFEST = "manifest.json"
+
+
+class FrameStore:
+    '''indexed frames in a directory'''
+
+    def __init__(self, directory, source: dict):
+        '''source describes what the frames are generated from, i.e. input file, frame count and payload'''
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        # frame index -> frame file, left over temporary files are ignored
+        # the newest file wins, should a frame exist with several extensions
+        paths = sorted((path for path in self.directory.iterdir() if path.stem.isdigit() and path.suffix != '.tmp'),
+                       key=lambda path: path.stat().st_mtime)
+        self.frames = {int(path.stem): path for path in paths}
+
+        source = json.loads(json.dumps(source, default=str))
+        manifest = self.directory / MANIFEST
+        if manifest.exists():
+            if json.loads(manifest.read_text()) != source:
+                raise ValueError("frame store was created for a different input or payload", str(self.directory))
+        elif self.frames:
+            raise ValueError("frame store has frames of an unknown input", str(self.directory))
+        else:
+            manifest.write_text(json.dumps(source, indent=2))
+
+    def __contains__(self, index: int):
+        return index in self.frames
+
+    def __len__(self):
+        return len(self.frames)
+
+    def missing(self, count: int):
+        '''indices of the first `count` frames not in the store'''
+        return [index for index in range(count) if index not in self.frames]
+
+    def read(self, index: int) -> bytes:
+        return self.frames[index].read_bytes()
+
+    def write(self, index: int, image_bytes: bytes):
+        '''save a frame, written to a temporary file first to survive crashes mid-write'''
+        if image_bytes.startswith(JPG_SIG):
+            extension = ".jpg"
+        elif image_bytes.startswith(PNG_SIG):
+            extension = ".png"
+        else:
+            extension = ".img"
+
+        filename = self.directory / f"{index:08d}{extension}"
+        temp_filename = filename.with_suffix('.tmp')
+        temp_filename.write_bytes(image_bytes)
+        os.replace(temp_filename, filename)
+
+        # a frame rewritten with another file type leaves no stale file behind
+        previous = self.frames.get(index)
+        if previous is not None and previous != filename:
+            previous.unlink(missing_ok=True)
+        self.frames[index] = filename
@@ -6,55 +6,74 @@ puts out <original_filename>_img2img.png next to the original file
 
 add more servers to SERVERS to process stuff in parallel
 add to or change PAYLOAD to change image generation parameters
+
+set JOB_QUEUE to share the work with other clients running the same command (needs job_queue.py next to it)
+
+set METADATA_INDEX to read generation parameters from an index built by metadata_index.py
+instead of parsing every image, and INDEX_QUERY to filter and sort the jobs by them
+
+set COST_HISTORY to run the longest jobs first, on the servers predicted to finish them first,
+learning the speed of each server over runs (needs cost_model.py next to it)
 """
 import asyncio
 import base64
 import logging
 import sys
-from io import BytesIO
+import time
 from pathlib import Path
 
 from aiofiles import open, ospath
 from aiohttp import ClientSession, ClientTimeout
+from cost_model import CostModel, CostQueue, job_units
+from job_queue import JobQueue, print_progress, work
+from metadata_index import MetadataIndex
 from PIL import Image
 from sd_parsers import ParserManager
+from upload import FileField, json_body
 
 SERVERS = ["http://127.0.0.1:7860"]
 
+# Extra request headers, i.e. {"X-User": "alice", "X-Priority": "1"} to queue behind job_service.py
+HEADERS = {}
+
+# Seconds to wait for an answer, None waits forever, i.e. for jobs queued behind others in job_service.py
+READ_TIMEOUT = 600
+
 PAYLOAD = {"steps": 5, "denoising_strength": 0.2}
 
-session_timeout = ClientTimeout(total=None, sock_connect=10, sock_read=600)
+# SQLite file (i.e. on a shared mount) to distribute jobs between several clients, e.g. "jobs.sqlite"
+JOB_QUEUE = None
+
+# Index file built by metadata_index.py, e.g. "images.sqlite"
+METADATA_INDEX = None
+
+# SQL condition on the index to select and order files by, needs METADATA_INDEX
+# e.g. "model = 'sd_xl_base' AND steps <= 30 ORDER BY prompt, seed"
+INDEX_QUERY = None
+
+# JSON file keeping the speed of each server between runs, e.g. "cost_history.json"
+# jobs are ordered by predicted cost then, instead of INDEX_QUERY or glob order
+COST_HISTORY = None
+
+session_timeout = ClientTimeout(total=None, sock_connect=10, sock_read=READ_TIMEOUT)
 queue: asyncio.Queue[Path] = asyncio.Queue()
 parser = ParserManager()
 
 parse_images = True
 """set to `False` to prevent the script from automatically populating the payload"""
 
+metadata_index: MetadataIndex = None
+"""generation parameters read from METADATA_INDEX, if set"""
+
 
 async def worker(server_address):
     """one of these guys is run for each SERVERS entry"""
-    async with ClientSession(server_address, timeout=session_timeout) as session:
+    async with ClientSession(server_address, timeout=session_timeout, headers=HEADERS) as session:
         while True:
             # get a filename from the queue
             filename = await queue.get()
             try:
-                # determine the output filename
-                # attention: the API does return the file type set in the backend options
-                #   see txt2img.py for one approach of handling this situation
-                output_filename = filename.with_stem(filename.stem + "_img2img")
-                if await ospath.exists(output_filename):
-                    raise ValueError("file already exists", output_filename)
-
-                # prepare the img2img payload
-                payload = await get_payload(filename)
-                # call the img2img API
-                images = await img2img(payload, session)
-
-                # save the output to disk
-                image_bytes = base64.b64decode(images[0])
-                async with open(output_filename, "wb") as fp:
-                    await fp.write(image_bytes)
-
+                await process_file(filename, session)
             except RuntimeError:
                 logging.exception("error interrogating file: %s", filename)
             except Exception:
@@ -63,8 +82,50 @@ async def worker(server_address):
             queue.task_done()
 
 
+async def costed_worker(server_address, jobs: CostQueue, cost_model: CostModel):
+    """like worker(), but takes the job picked for this server by the cost model and times it"""
+    async with ClientSession(server_address, timeout=session_timeout, headers=HEADERS) as session:
+        while True:
+            units, filename = await jobs.get_for(server_address)
+            start = time.monotonic()
+            try:
+                await process_file(filename, session)
+                cost_model.record(units, server_address, time.monotonic() - start)
+            except RuntimeError:
+                logging.exception("error interrogating file: %s", filename)
+            except Exception:
+                logging.exception("unexpected error")
+
+            jobs.task_done()
+
+
+async def shared_worker(server_address, jobs: JobQueue, directory: Path):
+    """like worker(), but takes jobs from a queue shared with other clients"""
+    async with ClientSession(server_address, timeout=session_timeout, headers=HEADERS) as session:
+        await work(jobs, lambda job: process_file(directory / job, session))
+
+
+async def process_file(filename: Path, session: ClientSession):
+    # determine the output filename
+    # attention: the API does return the file type set in the backend options
+    #   see txt2img.py for one approach of handling this situation
+    output_filename = filename.with_stem(filename.stem + "_img2img")
+    if await ospath.exists(output_filename):
+        raise ValueError("file already exists", output_filename)
+
+    # prepare the img2img payload
+    payload = await get_payload(filename)
+    # call the img2img API
+    images = await img2img(payload, session)
+
+    # save the output to disk
+    image_bytes = base64.b64decode(images[0])
+    async with open(output_filename, "wb") as fp:
+        await fp.write(image_bytes)
+
+
 async def img2img(payload: dict, session: ClientSession):
-    async with session.post("/sdapi/v1/img2img", json=payload) as response:
+    async with session.post("/sdapi/v1/img2img", **await json_body(payload)) as response:
         if not response.ok:
             raise RuntimeError("error querying server", response.status, await response.text())
         result = await response.json()
@@ -73,27 +134,34 @@ async def img2img(payload: dict, session: ClientSession):
 
 async def get_payload(image_filename: Path, custom_payload=PAYLOAD):
     """build a payload from a given image and a custom payload"""
-    # read image
-    async with open(image_filename, mode="rb") as fp:
-        image_bytes = await fp.read()
-
-    # get image parameters
-    with BytesIO(image_bytes) as buffered, Image.open(buffered) as image:
-        mime_type = Image.MIME[image.format]
-        image_parameters = get_image_params(image) or {}
-        image_parameters.update({"height": image.height, "width": image.width})
-
-    # convert image to something we can POST to A1111
-    base64_image = base64.b64encode(image_bytes).decode("utf-8")
+    # reading and parsing the file blocks, keep it off the event loop
+    mime_type, image_parameters = await asyncio.to_thread(read_image_params, image_filename)
 
     return {
         **image_parameters,
         **custom_payload,
+        # the image is read and base64 encoded while the request is sent
         # The A1111 does not need a mime type for now. As we have it though, let's use it!
-        "init_images": [f"data:{mime_type};base64,{base64_image}"],
+        "init_images": [FileField(image_filename, prefix=f"data:{mime_type};base64,")],
     }
 
 
+def read_image_params(image_filename: Path):
+    """mime type and parameters of an image, from the index if it is up to date, otherwise from the file"""
+    entry = metadata_index.get(image_filename) if metadata_index is not None else None
+    if entry is not None:
+        mime_type, image_parameters = entry
+        if not parse_images:
+            image_parameters = {"height": image_parameters["height"], "width": image_parameters["width"]}
+        return mime_type, image_parameters
+
+    # PIL only reads as much of the file as needed for that
+    with Image.open(image_filename) as image:
+        image_parameters = get_image_params(image) or {}
+        image_parameters.update({"height": image.height, "width": image.width})
+        return Image.MIME[image.format], image_parameters
+
+
 def get_image_params(image):
     """parse image generation parameters from the given image"""
     if not parse_images:
@@ -103,6 +171,11 @@ def get_image_params(image):
     if not image_parameters:
         return None
 
+    return get_params(image_parameters)
+
+
+def get_params(image_parameters):
+    """payload parameters from parsed image generation parameters"""
     params = {}
     prompt = ", ".join(prompt.value for prompt in image_parameters.prompts)
     if prompt:
@@ -121,6 +194,23 @@ def get_image_params(image):
     return params
 
 
+def estimate_units(image_filename: Path) -> float:
+    """cost of a job from the image size (taken from the index if possible) and PAYLOAD
+
+    the image's own steps are not used, reading them would mean parsing every image up front.
+    set "steps" in PAYLOAD for the estimates to match the jobs, otherwise job_units() assumes 20
+    """
+    entry = metadata_index.get(image_filename) if metadata_index is not None else None
+    if entry is not None:
+        image_size = {"height": entry[1]["height"], "width": entry[1]["width"]}
+    else:
+        # PIL only reads the file header for the size
+        with Image.open(image_filename) as image:
+            image_size = {"height": image.height, "width": image.width}
+
+    return job_units({**image_size, **PAYLOAD, "init_images": []})
+
+
 async def run():
     # create worker tasks
     tasks = [asyncio.create_task(worker(server_address)) for server_address in SERVERS]
@@ -135,12 +225,74 @@ async def run():
     await asyncio.gather(*tasks, return_exceptions=True)
 
 
+async def run_shared(dir_path: Path, filenames: list):
+    jobs = JobQueue(JOB_QUEUE)
+
+    # every client adds the same files, paths relative to the directory are the same on all of them
+    added = jobs.add(str(filename.relative_to(dir_path)) for filename in filenames)
+    print(f"{added} new jobs added to {JOB_QUEUE}")
+
+    await asyncio.gather(*(shared_worker(server_address, jobs, dir_path) for server_address in SERVERS))
+
+    print_progress(jobs)
+
+
+async def run_costed(filenames: list):
+    cost_model = CostModel(COST_HISTORY)
+    jobs = CostQueue(cost_model, SERVERS)
+    estimates = []
+    for filename in filenames:
+        try:
+            units = await asyncio.to_thread(estimate_units, filename)
+        except Exception:
+            # leave it to the worker to report the file
+            units = job_units(PAYLOAD)
+        estimates.append(units)
+        jobs.put_nowait((units, filename))
+
+    predicted = cost_model.makespan(estimates, SERVERS)
+    print(f"{len(filenames)} jobs, predicted to take {predicted:.0f}s")
+
+    start = time.monotonic()
+    tasks = [asyncio.create_task(costed_worker(server_address, jobs, cost_model)) for server_address in SERVERS]
+    try:
+        await jobs.join()
+    finally:
+        # shut down workers, keep what was learned even if the run was interrupted
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        cost_model.save()
+
+    print(f"took {time.monotonic() - start:.0f}s, "
+          f"job times off from predictions by {cost_model.drift():.0%} on average")
+
+
 async def main(directory, glob_pattern):
+    global metadata_index
+
     dir_path = Path(directory)
     if not dir_path.exists():
         raise ValueError("directory does not exist")
 
-    for filename in dir_path.glob(glob_pattern):
+    filenames = list(dir_path.glob(glob_pattern))
+
+    if METADATA_INDEX is not None:
+        metadata_index = MetadataIndex(METADATA_INDEX)
+        if INDEX_QUERY is not None:
+            # keep the order of the query, drop files not matching the glob pattern
+            selected = {filename.resolve(): filename for filename in filenames}
+            filenames = [selected[path] for path in metadata_index.query(INDEX_QUERY) if path in selected]
+
+    if JOB_QUEUE is not None:
+        await run_shared(dir_path, filenames)
+        return
+
+    if COST_HISTORY is not None:
+        await run_costed(filenames)
+        return
+
+    for filename in filenames:
         queue.put_nowait(filename)
 
     await run()
@@ -0,0 +1,259 @@
+"""
+usage: python3 img2img_tiled.py <directory> <glob pattern>
+i.e.: python3 img2img_tiled.py scans **/*.png
+
+puts out <original_filename>_img2img.png next to the original file
+
+like img2img.py, but for images too large to process in one go:
+splits each image into overlapping tiles, processes the tiles on all SERVERS concurrently
+and blends them back together with feathered seams, one row of tiles after another
+
+client memory: about 6 bytes per pixel for each of CONCURRENT_FILES (source and output image, 8 bit RGB),
+plus a band of TILE_SIZE rows blended in float, i.e. ~4 GB for a 30000x20000 scan
+
+add more servers to SERVERS to process stuff in parallel
+add to or change PAYLOAD to change image generation parameters
+
+Needs img2img.py next to it.
+"""
+import asyncio
+import base64
+import contextlib
+import logging
+import sys
+from io import BytesIO
+from pathlib import Path
+
+import img2img
+import numpy as np
+from aiofiles import open, ospath
+from aiohttp import ClientSession
+from PIL import Image
+
+SERVERS = ["http://127.0.0.1:7860"]
+
+PAYLOAD = {"steps": 20, "denoising_strength": 0.3}
+
+# Size of the tiles sent to the backends (multiples of 8)
+TILE_SIZE = 768
+
+# Overlap between neighbouring tiles, blended on the client
+TILE_OVERLAP = 128
+
+# Number of images worked on at the same time, each one is held in memory in full
+CONCURRENT_FILES = 2
+
+# Rows of tiles being processed at the same time, per image
+ROWS_AHEAD = 2
+
+# large scans easily exceed PIL's decompression bomb limit
+Image.MAX_IMAGE_PIXELS = None
+
+queue: asyncio.Queue[Path] = asyncio.Queue()
+
+
+def tile_positions(size: int, tile_size: int, overlap: int) -> list:
+    """start positions of the tiles along one axis, the last tile is aligned to the end"""
+    if size <= tile_size:
+        return [0]
+    positions = list(range(0, size - tile_size, tile_size - overlap))
+    return positions + [size - tile_size]
+
+
+def feather(length: int, overlap: int, at_start: bool, at_end: bool) -> np.ndarray:
+    """blend weights along one tile axis, fading out towards neighbouring tiles (but not the image border)"""
+    weights = np.ones(length, np.float32)
+    ramp = np.linspace(0, 1, overlap + 2, dtype=np.float32)[1:-1]
+    if not at_start:
+        weights[:overlap] = ramp
+    if not at_end:
+        weights[-overlap:] = ramp[::-1]
+    return weights
+
+
+def encode_tile(tile: np.ndarray) -> str:
+    with Image.fromarray(tile) as image, BytesIO() as buffer:
+        image.save(buffer, "PNG")
+        return base64.b64encode(buffer.getvalue()).decode("utf-8")
+
+
+def decode_tile(base64_image: str, size: tuple) -> np.ndarray:
+    with BytesIO(base64.b64decode(base64_image)) as buffer, Image.open(buffer) as image:
+        image = image.convert("RGB")
+        if image.size != size:
+            image = image.resize(size)
+        return np.asarray(image)
+
+
+class Blender:
+    """puts processed tiles together row by row, weighting overlapping areas
+
+    only the band of rows still receiving tiles is kept in float, finished rows go to the 8 bit output
+    """
+
+    def __init__(self, height: int, width: int):
+        self.output = np.empty((height, width, 3), np.uint8)
+        band = min(TILE_SIZE, height)
+        self.result = np.zeros((band, width, 3), np.float32)
+        self.weights = np.zeros((band, width, 1), np.float32)
+        # first row of the image in the band
+        self.top = 0
+        self.overlap = min(TILE_OVERLAP, TILE_SIZE // 2)
+
+    def finish(self, y: int):
+        """move the rows above y to the output, no more tiles start above it"""
+        rows = y - self.top
+        if rows <= 0:
+            return
+
+        self.output[self.top:y] = np.clip(self.result[:rows] / self.weights[:rows] + 0.5, 0, 255).astype(np.uint8)
+        # shift the band down the image
+        for band in (self.result, self.weights):
+            band[:-rows] = band[rows:].copy()
+            band[-rows:] = 0
+        self.top = y
+
+    def add_row(self, y: int, tiles: list):
+        """blend a row of processed tiles (x, tile) starting at y, rows have to come in order"""
+        self.finish(y)
+        height, width = self.output.shape[:2]
+        for x, tile in tiles:
+            tile_height, tile_width = tile.shape[:2]
+            weight = np.outer(
+                feather(tile_height, self.overlap, y == 0, y + tile_height == height),
+                feather(tile_width, self.overlap, x == 0, x + tile_width == width),
+            )[:, :, None]
+            self.result[:tile_height, x:x + tile_width] += tile * weight
+            self.weights[:tile_height, x:x + tile_width] += weight
+
+    def image(self) -> np.ndarray:
+        self.finish(self.output.shape[0])
+        return self.output
+
+
+def save_image(image: np.ndarray, filename: Path):
+    with Image.fromarray(image) as output:
+        output.save(filename, "PNG")
+
+
+async def process_tile(tile: np.ndarray, image_parameters: dict, sessions: asyncio.Queue) -> np.ndarray:
+    """process a single tile on the next free server"""
+    height, width = tile.shape[:2]
+    payload = {
+        **image_parameters,
+        **PAYLOAD,
+        "width": width,
+        "height": height,
+        "init_images": [await asyncio.to_thread(encode_tile, tile)],
+    }
+
+    session = await sessions.get()
+    try:
+        images = await img2img.img2img(payload, session)
+    finally:
+        sessions.put_nowait(session)
+
+    return await asyncio.to_thread(decode_tile, images[0], (width, height))
+
+
+async def process_file(filename: Path, sessions: asyncio.Queue):
+    # determine the output filename
+    output_filename = filename.with_stem(filename.stem + "_img2img").with_suffix(".png")
+    if await ospath.exists(output_filename):
+        raise ValueError("file already exists", output_filename)
+
+    # read image and its generation parameters
+    async with open(filename, mode="rb") as fp:
+        image_bytes = await fp.read()
+
+    with BytesIO(image_bytes) as buffered, Image.open(buffered) as image:
+        image_parameters = img2img.get_image_params(image) or {}
+        source = np.asarray(image.convert("RGB"))
+
+    height, width = source.shape[:2]
+    rows = tile_positions(height, TILE_SIZE, TILE_OVERLAP)
+    columns = tile_positions(width, TILE_SIZE, TILE_OVERLAP)
+
+    def start_row(y: int) -> list:
+        # the tiles of a row are processed concurrently, the sessions queue hands them to free servers
+        return [asyncio.create_task(process_tile(source[y:y + TILE_SIZE, x:x + TILE_SIZE], image_parameters, sessions))
+                for x in columns]
+
+    # blend the rows as they come in, while the next ones are processed
+    blender = Blender(height, width)
+    pending = [start_row(y) for y in rows[:ROWS_AHEAD]]
+    try:
+        for i, y in enumerate(rows):
+            tiles = await asyncio.gather(*pending.pop(0))
+            if i + ROWS_AHEAD < len(rows):
+                pending.append(start_row(rows[i + ROWS_AHEAD]))
+            await asyncio.to_thread(blender.add_row, y, list(zip(columns, tiles)))
+    finally:
+        for task in (task for row in pending for task in row):
+            task.cancel()
+
+    # save the output to disk
+    output = await asyncio.to_thread(blender.image)
+    await asyncio.to_thread(save_image, output, output_filename)
+
+
+async def worker(sessions: asyncio.Queue):
+    """one of these guys is run for each of CONCURRENT_FILES"""
+    while True:
+        # get a filename from the queue
+        filename = await queue.get()
+        try:
+            await process_file(filename, sessions)
+        except RuntimeError:
+            logging.exception("error processing file: %s", filename)
+        except Exception:
+            logging.exception("unexpected error")
+
+        queue.task_done()
+
+
+@contextlib.asynccontextmanager
+async def init_sessions():
+    """a queue of sessions, one for each SERVERS entry"""
+    sessions = asyncio.Queue()
+    for server_address in SERVERS:
+        sessions.put_nowait(ClientSession(server_address, timeout=img2img.session_timeout,
+                                          headers=img2img.HEADERS))
+    try:
+        yield sessions
+    finally:
+        while not sessions.empty():
+            await sessions.get_nowait().close()
+
+
+async def run():
+    async with init_sessions() as sessions:
+        # create worker tasks
+        tasks = [asyncio.create_task(worker(sessions)) for _ in range(CONCURRENT_FILES)]
+
+        # wait for all files to be processed
+        await queue.join()
+
+        # shut down workers
+        for task in tasks:
+            task.cancel()
+
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def main(directory, glob_pattern):
+    dir_path = Path(directory)
+    if not dir_path.exists():
+        raise ValueError("directory does not exist")
+
+    for filename in dir_path.glob(glob_pattern):
+        queue.put_nowait(filename)
+
+    await run()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main(*sys.argv[1:3]))
+    except TypeError as error:
+        print(str(error))
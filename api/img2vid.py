@@ -2,33 +2,56 @@
 Usage: python3 img2vid.py <directory> <glob pattern> <output file name>
 i.e.: python3 img2vid.py images "**/*.png" output.mp4
 
-Needs img2img.py next to it.
+Needs img2img.py, vid2vid_ffmpeg.py and frame_store.py next to it.
 Needs ffmpeg.
 
 add more servers to SERVERS to process stuff in parallel
 add to or change PAYLOAD to change image generation parameters
 
 edit FFMPEG_INPUT_PARAMS, FFMPEG_OUTPUT_PARAMS and FFMPEG_FILTERS to influence the video creation process
+
+set FRAME_STORE to keep generated frames on disk:
+an interrupted run then only generates the missing frames when started again,
+and a finished one can be re-encoded without calling the backends
 '''
 import asyncio
 import base64
 import contextlib
+import logging
 import sys
 from pathlib import Path
+from queue import Full
 
-import ffmpeg
 import img2img
+import vid2vid_ffmpeg
+from frame_store import FrameStore
 from aiohttp import ClientSession, ClientTimeout
 
 img2img.parse_images = False
 
 SERVERS = ["http://127.0.0.1:7860"]
 
+# Extra request headers, i.e. {"X-User": "alice", "X-Priority": "1"} to queue behind job_service.py
+HEADERS = {}
+
+# Seconds to wait for an answer, None waits forever, i.e. for jobs queued behind others in job_service.py
+READ_TIMEOUT = 600
+
 PAYLOAD = {
     "steps": 30,
     "denoising_strength": 0.2
 }
 
+# Decode generated images once and pipe raw rgb24 frames to ffmpeg,
+# instead of making ffmpeg decode every PNG/JPEG again.
+RAW_FRAMES = True
+
+# Number of frames the writer thread may buffer before generation has to wait
+FRAME_BUFFER_SIZE = 32
+
+# Directory to keep generated frames in, e.g. "output_frames"
+FRAME_STORE = None
+
 FFMPEG_INPUT_PARAMS = {
     'framerate': 12
 }
@@ -61,26 +84,12 @@ FFMPEG_FILTERS = {
     }
 }
 
-session_timeout = ClientTimeout(total=None, sock_connect=10, sock_read=600)
-queue = asyncio.Queue()
+session_timeout = ClientTimeout(total=None, sock_connect=10, sock_read=READ_TIMEOUT)
 
 
-async def ffmpeg_worker(ffmpeg_process):
-    '''worker task to pass queued images to the ffmpeg process'''
-    async def async_write(process, image: bytes):
-        '''helper function to call process.stdin.write asynchronously'''
-        loop = asyncio.get_running_loop()
-        await loop.run_in_executor(None, process.stdin.write, image)
-
-    while True:
-        image = await queue.get()
-        await async_write(ffmpeg_process, image)
-        queue.task_done()
-
-
-def init_ffmpeg(output_filename: str, overwrite_output: bool = True):
+def init_ffmpeg(output_filename: str, frame_size: tuple = None, overwrite_output: bool = True):
     # input
-    input = ffmpeg.input('pipe:', format='image2pipe', **FFMPEG_INPUT_PARAMS)
+    input = vid2vid_ffmpeg.pipe_input(frame_size, **FFMPEG_INPUT_PARAMS)
 
     # filters
     for name, params in FFMPEG_FILTERS.items():
@@ -91,8 +100,21 @@ def init_ffmpeg(output_filename: str, overwrite_output: bool = True):
     if overwrite_output:
         out = out.overwrite_output()
 
-    # run ffmpeg process
-    return out.run_async(pipe_stdin=True)
+    # run ffmpeg process and a thread feeding it
+    writer = vid2vid_ffmpeg.FrameWriter(out.run_async(pipe_stdin=True), FRAME_BUFFER_SIZE, frame_size)
+    writer.start()
+    return writer
+
+
+async def write_frame(writer: vid2vid_ffmpeg.FrameWriter, frame):
+    '''pass a frame to the writer thread, only leave the event loop if its buffer is full'''
+    if writer.error is not None:
+        raise RuntimeError("error writing to ffmpeg") from writer.error
+    frame = writer.fit(frame)
+    try:
+        writer.frames.put_nowait(frame)
+    except Full:
+        await asyncio.to_thread(writer.write, frame)
 
 
 @contextlib.asynccontextmanager
@@ -100,7 +122,7 @@ async def init_sessions():
     '''handle the creation and closing of multiple ClientSession objects'''
     sessions = []
     for server_address in SERVERS:
-        sessions.append(ClientSession(server_address, timeout=session_timeout))
+        sessions.append(ClientSession(server_address, timeout=session_timeout, headers=HEADERS))
     try:
         yield sessions
     finally:
@@ -118,44 +140,74 @@ async def get_image(filename, session) -> bytes:
     return base64.b64decode(images[0])
 
 
+async def get_frame(index: int, filename, session, store: FrameStore = None):
+    '''get a frame from the store or process it with the img2img API'''
+    if store is not None and index in store:
+        image_bytes = await asyncio.to_thread(store.read, index)
+    else:
+        image_bytes = await get_image(filename, session)
+        if store is not None:
+            await asyncio.to_thread(store.write, index, image_bytes)
+
+    if not RAW_FRAMES:
+        return image_bytes
+    # return image as decoded frame
+    return await asyncio.to_thread(vid2vid_ffmpeg.decode_frame, image_bytes)
+
+
 async def main(directory, glob_pattern, output_filename):
-    # list of input image files
-    files = list(Path(directory).glob(glob_pattern))
+    # list of input image files, sorted to keep frame indices stable between runs
+    files = sorted(Path(directory).glob(glob_pattern))
+
+    store = None
+    if FRAME_STORE is not None:
+        source = {"input": str(Path(directory).resolve()), "glob": glob_pattern, "frames": len(files),
+                  "payload": PAYLOAD}
+        store = FrameStore(FRAME_STORE, source)
+        print(f"{len(store.missing(len(files)))} of {len(files)} frames left to generate")
 
-    # start up ffmpeg and ffmpeg helper task
-    ffmpeg_process = init_ffmpeg(output_filename)
-    ffmpeg_task = asyncio.create_task(ffmpeg_worker(ffmpeg_process))
+    # ffmpeg is started with the first finished image,
+    # as raw frames need their size known upfront
+    writer = None
 
     # use as many concurrent img2img workers as there are SERVERS
     async with init_sessions() as sessions:
-        num_sessions = len(sessions)
         index = 0
 
-        # loop over files in steps of `num_sessions`
         while index < len(files):
-            img2img_tasks = [get_image(file, sessions[i])
-                             for i, file in enumerate(files[index:index+num_sessions])]
+            # take as many files as needed to give each session one image to process,
+            # frames already in the store come along without using a session
+            batch = []
+            free_sessions = iter(sessions)
+            while index < len(files) and len(batch) < FRAME_BUFFER_SIZE:
+                if store is not None and index in store:
+                    session = None
+                elif (session := next(free_sessions, None)) is None:
+                    break
+                batch.append((index, session))
+                index += 1
+
+            img2img_tasks = [get_frame(i, files[i], session, store) for i, session in batch]
 
             # wait for each img2img batch to finish
             images = await asyncio.gather(*img2img_tasks, return_exceptions=True)
-            # and put the image into the queue in the same order as they were before
-            for image in images:
-                queue.put_nowait(image)
-
-            index += num_sessions
-
-    # wait for all files to be processed
-    await queue.join()
-
-    # shut down ffmpeg and ffmpeg helper task
-    ffmpeg_task.cancel()
-    try:
-        await ffmpeg_task
-    except asyncio.CancelledError:
-        pass
-
-    ffmpeg_process.stdin.close()
-    ffmpeg_process.wait()
+            # and pass the images on in the same order as they were before
+            for (i, _), image in zip(batch, images):
+                if isinstance(image, Exception):
+                    logging.error("error processing file: %s", files[i], exc_info=image)
+                    continue
+
+                if writer is None:
+                    frame_size = (image.shape[1], image.shape[0]) if RAW_FRAMES else None
+                    writer = init_ffmpeg(output_filename, frame_size)
+                await write_frame(writer, image)
+
+    # wait for all frames to be written and shut down ffmpeg
+    if writer is not None:
+        await asyncio.to_thread(writer.close)
+
+    if store is not None and (missing := store.missing(len(files))):
+        print(f"{len(missing)} frames failed, run again to generate them")
 
 
 if __name__ == "__main__":
@@ -5,45 +5,54 @@ i.e.: python3 interrogate.py images **/*.png
 puts out <original_filename>.txt next to the original file
 
 add more servers to SERVERS to process stuff in parallel
+
+set JOB_QUEUE to share the work with other clients running the same command (needs job_queue.py next to it)
+
+set DEDUPLICATE to interrogate only one image of each group of near-duplicates (needs dedupe.py next to it),
+the caption is copied to the others
 '''
 import asyncio
-import base64
 import logging
 import sys
 from pathlib import Path
 
 from aiofiles import open, ospath
 from aiohttp import ClientSession, ClientTimeout
+from dedupe import find_clusters
+from job_queue import JobQueue, print_progress, work
+from upload import FileField, json_body
 
 SERVERS = ["http://127.0.0.1:7860"]
 
+# Extra request headers, i.e. {"X-User": "alice", "X-Priority": "1"} to queue behind job_service.py
+HEADERS = {}
+
+# Seconds to wait for an answer, None waits forever, i.e. for jobs queued behind others in job_service.py
+READ_TIMEOUT = 600
+
 MODEL = "clip"
 
-session_timeout = ClientTimeout(total=None, sock_connect=10, sock_read=600)
+# Interrogate only one image of each group of near-duplicates (resized or recompressed copies)
+DEDUPLICATE = False
+
+# Number of differing bits (out of 64) for two images to count as near-duplicates
+DUPLICATE_DISTANCE = 6
+
+# SQLite file (i.e. on a shared mount) to distribute jobs between several clients, e.g. "jobs.sqlite"
+JOB_QUEUE = None
+
+session_timeout = ClientTimeout(total=None, sock_connect=10, sock_read=READ_TIMEOUT)
 queue = asyncio.Queue()
 
 
 async def worker(server_address):
     '''one of these guys is run for each SERVERS entry'''
-    async with ClientSession(server_address, timeout=session_timeout) as session:
+    async with ClientSession(server_address, timeout=session_timeout, headers=HEADERS) as session:
         while True:
             # get a filename from the queue
             filename = await queue.get()
             try:
-                # determine the output filename
-                output_filename = filename.with_suffix('.txt')
-                if await ospath.exists(output_filename):
-                    raise ValueError("file already exists", output_filename)
-
-                # prepare the img2img payload
-                payload = await get_payload(filename)
-                # call the interrogate API
-                caption = await interrogate(payload, session)
-
-                # save the output to disk
-                async with open(output_filename, 'w', encoding='utf-8') as fp:
-                    await fp.write(caption)
-
+                await process_file(filename, session)
             except RuntimeError:
                 logging.exception("error interrogating file: %s", filename)
             except Exception:
@@ -52,8 +61,30 @@ async def worker(server_address):
             queue.task_done()
 
 
+async def shared_worker(server_address, jobs: JobQueue, directory: Path):
+    '''like worker(), but takes jobs from a queue shared with other clients'''
+    async with ClientSession(server_address, timeout=session_timeout, headers=HEADERS) as session:
+        await work(jobs, lambda job: process_file(directory / job, session))
+
+
+async def process_file(filename: Path, session: ClientSession):
+    # determine the output filename
+    output_filename = filename.with_suffix('.txt')
+    if await ospath.exists(output_filename):
+        raise ValueError("file already exists", output_filename)
+
+    # prepare the img2img payload
+    payload = await get_payload(filename)
+    # call the interrogate API
+    caption = await interrogate(payload, session)
+
+    # save the output to disk
+    async with open(output_filename, 'w', encoding='utf-8') as fp:
+        await fp.write(caption)
+
+
 async def interrogate(payload: dict, session: ClientSession):
-    async with session.post('/sdapi/v1/interrogate', json=payload) as response:
+    async with session.post('/sdapi/v1/interrogate', **await json_body(payload)) as response:
         if not response.ok:
             raise RuntimeError("error querying server", response.status, await response.text())
         result = await response.json()
@@ -62,13 +93,9 @@ async def interrogate(payload: dict, session: ClientSession):
 
 async def get_payload(image_filename: Path):
     '''build a payload from given image'''
-    # read image & convert to base64 encoded string
-    async with open(image_filename, mode='rb') as fp:
-        base64_image = base64.b64encode(await fp.read()).decode('utf-8')
-
-    # assemble payload
+    # assemble payload, the image is read and base64 encoded while the request is sent
     return {
-        "image": base64_image,
+        "image": FileField(image_filename),
         "model": MODEL
     }
 
@@ -88,15 +115,59 @@ async def run():
     await asyncio.gather(*tasks, return_exceptions=True)
 
 
+async def run_shared(dir_path: Path, filenames: list):
+    jobs = JobQueue(JOB_QUEUE)
+
+    # every client adds the same files, paths relative to the directory are the same on all of them
+    added = jobs.add(str(filename.relative_to(dir_path)) for filename in filenames)
+    print(f"{added} new jobs added to {JOB_QUEUE}")
+
+    await asyncio.gather(*(shared_worker(server_address, jobs, dir_path) for server_address in SERVERS))
+
+    print_progress(jobs)
+
+
+async def copy_captions(clusters: dict):
+    '''copy the captions of interrogated images to their near-duplicates'''
+    for representative, members in clusters.items():
+        caption_filename = representative.with_suffix('.txt')
+        if not members or not await ospath.exists(caption_filename):
+            continue
+
+        async with open(caption_filename, 'r', encoding='utf-8') as fp:
+            caption = await fp.read()
+
+        for member in members:
+            output_filename = member.with_suffix('.txt')
+            if await ospath.exists(output_filename):
+                continue
+            async with open(output_filename, 'w', encoding='utf-8') as fp:
+                await fp.write(caption)
+
+
 async def main(directory, glob_pattern):
     dir_path = Path(directory)
     if not dir_path.exists():
         raise ValueError("directory does not exist")
 
-    for filename in dir_path.glob(glob_pattern):
-        queue.put_nowait(filename)
+    filenames = sorted(dir_path.glob(glob_pattern))
+
+    clusters = {}
+    if DEDUPLICATE:
+        clusters = await asyncio.to_thread(find_clusters, filenames, DUPLICATE_DISTANCE)
+        filenames = list(clusters)
+        saved = sum(len(members) for members in clusters.values())
+        print(f"found {saved} near-duplicates among {len(filenames) + saved} images, saving {saved} backend calls")
+
+    if JOB_QUEUE is not None:
+        await run_shared(dir_path, filenames)
+    else:
+        for filename in filenames:
+            queue.put_nowait(filename)
+
+        await run()
 
-    await run()
+    await copy_captions(clusters)
 
 
 if __name__ == "__main__":
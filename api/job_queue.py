@@ -0,0 +1,166 @@
+'''
+usage: python3 job_queue.py <queue file>
+
+shows the progress of a shared job queue
+
+job queue in an SQLite database, shared between several client processes (i.e. on a shared mount),
+used by img2img.py and interrogate.py with JOB_QUEUE set
+
+each client leases one job at a time and keeps its lease alive while processing it,
+jobs of crashed or vanished clients are picked up again once their lease expired
+
+lease times are taken from the modification time of a clock file next to the database (<queue file>.clock),
+set by the file server on a shared mount, so clients don't depend on their own clocks agreeing.
+file systems keeping the client's time instead (some SMB setups) need the client clocks in sync (i.e. NTP),
+well within LEASE_TIME
+
+attention: SQLite relies on file locking, which some network file systems do not get right
+'''
+import asyncio
+import contextlib
+import logging
+import os
+import socket
+import sqlite3
+import sys
+from pathlib import Path
+
+# Seconds a lease is valid without a heartbeat
+LEASE_TIME = 60
+
+# Number of times a job is leased before giving up on it
+MAX_ATTEMPTS = 3
+
+
+class JobQueue:
+    '''jobs in an SQLite database'''
+
+    def __init__(self, path, lease_time: float = LEASE_TIME, client: str = None):
+        self.path = path
+        self.lease_time = lease_time
+        self.client = client or f"{socket.gethostname()}:{os.getpid()}"
+        self.clock = Path(f"{path}.clock")
+        self.clock.touch()
+
+        with self.transaction() as db:
+            db.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                job TEXT PRIMARY KEY,
+                state TEXT NOT NULL DEFAULT 'pending',
+                client TEXT,
+                lease_until REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT
+            )''')
+
+    @contextlib.contextmanager
+    def transaction(self):
+        '''a connection with an exclusive write transaction, one per call to stay thread safe'''
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                yield db
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+        finally:
+            db.close()
+
+    def now(self) -> float:
+        '''current time of the file server, shared by all clients'''
+        # without explicit times, the file server sets the modification time to its own
+        os.utime(self.clock)
+        return self.clock.stat().st_mtime
+
+    def add(self, jobs) -> int:
+        '''add jobs, jobs already in the queue are ignored, returns the number of new jobs'''
+        with self.transaction() as db:
+            return db.executemany("INSERT OR IGNORE INTO jobs (job) VALUES (?)",
+                                  ((job,) for job in jobs)).rowcount
+
+    def lease(self):
+        '''lease the next pending (or expired) job, None if there is none'''
+        now = self.now()
+        with self.transaction() as db:
+            row = db.execute('''SELECT job FROM jobs
+                WHERE (state = 'pending' OR (state = 'leased' AND lease_until < ?)) AND attempts < ?
+                ORDER BY rowid LIMIT 1''', (now, MAX_ATTEMPTS)).fetchone()
+            if row is None:
+                return None
+
+            db.execute('''UPDATE jobs SET state = 'leased', client = ?, lease_until = ?, attempts = attempts + 1
+                WHERE job = ?''', (self.client, now + self.lease_time, row[0]))
+        return row[0]
+
+    def heartbeat(self, job) -> bool:
+        '''renew the lease on a job, False if it was lost to another client'''
+        with self.transaction() as db:
+            return db.execute('''UPDATE jobs SET lease_until = ?
+                WHERE job = ? AND client = ? AND state = 'leased' ''',
+                              (self.now() + self.lease_time, job, self.client)).rowcount > 0
+
+    def finish(self, job, error: str = None):
+        '''mark a leased job as done (or failed, if an error is given)'''
+        with self.transaction() as db:
+            db.execute('''UPDATE jobs SET state = ?, error = ?, lease_until = NULL
+                WHERE job = ? AND client = ? AND state = 'leased' ''',
+                       ('done' if error is None else 'failed', error, job, self.client))
+
+    def progress(self) -> dict:
+        '''number of jobs by state, leased jobs out of attempts count as failed'''
+        now = self.now()
+        with self.transaction() as db:
+            rows = db.execute('''SELECT CASE
+                    WHEN state IN ('pending', 'leased') AND attempts >= ? AND (lease_until IS NULL OR lease_until < ?)
+                    THEN 'failed' ELSE state END, COUNT(*)
+                FROM jobs GROUP BY 1''', (MAX_ATTEMPTS, now)).fetchall()
+        return {'pending': 0, 'leased': 0, 'done': 0, 'failed': 0, **dict(rows)}
+
+
+async def keep_alive(jobs: JobQueue, job):
+    '''renew a lease until cancelled'''
+    while True:
+        await asyncio.sleep(jobs.lease_time / 3)
+        if not await asyncio.to_thread(jobs.heartbeat, job):
+            logging.warning("lost lease on job: %s", job)
+            return
+
+
+async def work(jobs: JobQueue, process):
+    '''lease jobs and await `process(job)` for each, until no job is left to do by any client'''
+    while True:
+        job = await asyncio.to_thread(jobs.lease)
+        if job is None:
+            # leases of other clients may still expire and need to be picked up
+            progress = await asyncio.to_thread(jobs.progress)
+            if progress['pending'] == 0 and progress['leased'] == 0:
+                return
+            await asyncio.sleep(jobs.lease_time / 3)
+            continue
+
+        heartbeat = asyncio.create_task(keep_alive(jobs, job))
+        try:
+            await process(job)
+        except Exception as error:
+            logging.exception("error processing job: %s", job)
+            await asyncio.to_thread(jobs.finish, job, repr(error))
+        else:
+            await asyncio.to_thread(jobs.finish, job)
+        finally:
+            heartbeat.cancel()
+
+
+def print_progress(jobs: JobQueue):
+    print(", ".join(f"{state}: {count}" for state, count in jobs.progress().items()))
+
+
+def main(path):
+    print_progress(JobQueue(path))
+
+
+if __name__ == "__main__":
+    try:
+        main(*sys.argv[1:2])
+    except TypeError as error:
+        print(str(error))
@@ -0,0 +1,165 @@
+'''
+usage: python3 job_service.py
+
+long-running local service owning the backend servers, to be shared by several users and scripts
+
+accepts the usual A1111 API calls (/sdapi/v1/txt2img, img2img, interrogate, extras...) on localhost,
+queues them by priority and hands them to the next free backend in SERVERS,
+taking turns between users with the same priority. results are streamed back as they come.
+
+to use it, point the SERVERS (or URL) of the other scripts at the service,
+repeat the entry to keep several jobs in flight, i.e.:
+    SERVERS = ["http://127.0.0.1:7800"] * 4
+
+and set their HEADERS to tell the service who is asking and how urgent it is (lower runs first), i.e.:
+    HEADERS = {"X-User": "alice", "X-Priority": "1"}
+
+without X-User all local clients count as one user (they all come from 127.0.0.1),
+without X-Priority DEFAULT_PRIORITY is used
+
+nothing is sent back while a request waits for its turn, which counts against the read timeout of the client.
+set READ_TIMEOUT = None in the other scripts, so waiting behind other users' jobs doesn't time them out
+
+GET /jobs shows what is running and waiting
+'''
+import asyncio
+from collections import OrderedDict, deque
+
+from aiohttp import ClientSession, ClientTimeout, web
+
+SERVERS = ["http://127.0.0.1:7860"]
+
+HOST = "127.0.0.1"
+PORT = 7800
+
+# Jobs run on a backend server at the same time
+JOBS_PER_SERVER = 1
+
+# Priority of requests without X-Priority header, lower runs first
+DEFAULT_PRIORITY = 5
+
+session_timeout = ClientTimeout(total=None, sock_connect=10, sock_read=600)
+
+
+class BackendPool:
+    '''hands out backend servers by priority, taking turns between users within a priority'''
+
+    def __init__(self, servers: list):
+        self.free = list(servers)
+        self.running = []
+        # priority -> user -> waiting futures, users rotate to the end when served
+        self.waiting = {}
+
+    async def acquire(self, user: str, priority: int) -> str:
+        if self.free and not self.waiting:
+            server_address = self.free.pop(0)
+        else:
+            future = asyncio.get_running_loop().create_future()
+            self.waiting.setdefault(priority, OrderedDict()).setdefault(user, deque()).append(future)
+            try:
+                server_address = await future
+            except asyncio.CancelledError:
+                # the client went away, maybe just after being handed a server
+                if future.done() and not future.cancelled():
+                    self.release(future.result())
+                raise
+
+        self.running.append((server_address, user))
+        return server_address
+
+    def release(self, server_address: str, user: str = None):
+        if (server_address, user) in self.running:
+            self.running.remove((server_address, user))
+
+        while self.waiting:
+            priority = min(self.waiting)
+            users = self.waiting[priority]
+            next_user, futures = next(iter(users.items()))
+            future = futures.popleft()
+
+            # next user's turn
+            users.move_to_end(next_user)
+            if not futures:
+                del users[next_user]
+            if not users:
+                del self.waiting[priority]
+
+            if not future.done():
+                future.set_result(server_address)
+                return
+
+        self.free.append(server_address)
+
+    def status(self) -> dict:
+        return {
+            "free": self.free,
+            "running": [{"server": server_address, "user": user} for server_address, user in self.running],
+            "waiting": {priority: {user: len(futures) for user, futures in users.items()}
+                        for priority, users in sorted(self.waiting.items())},
+        }
+
+
+def client_gone(request: web.Request) -> bool:
+    transport = request.transport
+    return transport is None or transport.is_closing()
+
+
+async def forward(request: web.Request) -> web.StreamResponse:
+    '''queue an API call, pass it on to a backend and stream the answer back'''
+    pool: BackendPool = request.app["pool"]
+    user = request.headers.get("X-User", request.remote)
+    try:
+        priority = int(request.headers.get("X-Priority", DEFAULT_PRIORITY))
+    except ValueError:
+        raise web.HTTPBadRequest(text="X-Priority must be a number")
+
+    # clients going away while waiting cancel this handler (see handler_cancellation in main()),
+    # which drops their place in the queue
+    if client_gone(request):
+        return web.Response(status=499, text="client closed request")
+    server_address = await pool.acquire(user, priority)
+    try:
+        # don't forward the truncated body of a client that went away just now
+        if client_gone(request):
+            return web.Response(status=499, text="client closed request")
+
+        session = request.app["sessions"][server_address]
+        # the request body is only read from the client once it is its turn
+        headers = {key: request.headers[key] for key in ("Content-Type", "Content-Length") if key in request.headers}
+        async with session.request(request.method, request.path_qs, data=request.content, headers=headers) as backend:
+            response = web.StreamResponse(status=backend.status)
+            response.content_type = backend.content_type
+            await response.prepare(request)
+            async for chunk in backend.content.iter_chunked(64 * 1024):
+                await response.write(chunk)
+            await response.write_eof()
+            return response
+    finally:
+        pool.release(server_address, user)
+
+
+async def status(request: web.Request) -> web.Response:
+    return web.json_response(request.app["pool"].status())
+
+
+async def init_sessions(app: web.Application):
+    '''handle the creation and closing of the backend sessions'''
+    app["sessions"] = {server_address: ClientSession(server_address, timeout=session_timeout)
+                       for server_address in SERVERS}
+    app["pool"] = BackendPool(SERVERS * JOBS_PER_SERVER)
+    yield
+    await asyncio.gather(*(session.close() for session in app["sessions"].values()))
+
+
+def main():
+    app = web.Application()
+    app.cleanup_ctx.append(init_sessions)
+    app.add_routes([
+        web.get("/jobs", status),
+        web.route("*", "/sdapi/v1/{endpoint:.*}", forward),
+    ])
+    web.run_app(app, host=HOST, port=PORT, handler_cancellation=True)
+
+
+if __name__ == "__main__":
+    main()
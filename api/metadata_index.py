@@ -0,0 +1,149 @@
+'''
+usage: python3 metadata_index.py <directory> <glob pattern> <index file>
+i.e.: python3 metadata_index.py images "**/*.png" images.sqlite
+
+scans images for their generation parameters (using sd-parsers, like img2img.py) in parallel
+and keeps them in an SQLite index, keyed by path, modification time and size.
+running it again only scans new or changed files.
+
+set METADATA_INDEX in img2img.py to read the generation parameters from the index instead of the images,
+and INDEX_QUERY to filter and sort the jobs by them
+
+Needs img2img.py next to it.
+'''
+import json
+import logging
+import os
+import sqlite3
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from PIL import Image
+
+COLUMNS = {
+    "mime_type": "TEXT",
+    "width": "INTEGER",
+    "height": "INTEGER",
+    "prompt": "TEXT",
+    "negative_prompt": "TEXT",
+    "sampler": "TEXT",
+    "model": "TEXT",
+    "seed": "INTEGER",
+    "steps": "INTEGER",
+}
+
+
+def read_metadata(filename: str):
+    '''generation parameters of an image, None if it can't be read'''
+    # imported here, as img2img.py uses this module as well
+    import img2img
+
+    try:
+        with Image.open(filename) as image:
+            mime_type = Image.MIME[image.format]
+            width, height = image.size
+            image_parameters = img2img.parser.parse(image)
+    except Exception:
+        logging.exception("error reading file: %s", filename)
+        return None
+
+    params = img2img.get_params(image_parameters) if image_parameters else {}
+    model = next((model.name for model in image_parameters.models), None) if image_parameters else None
+    return {
+        "mime_type": mime_type,
+        "width": width,
+        "height": height,
+        "prompt": params.get("prompt"),
+        "negative_prompt": params.get("negative_prompt"),
+        "sampler": params.get("sampler_index"),
+        "model": model,
+        "seed": params.get("seed"),
+        "steps": params.get("steps"),
+        "params": json.dumps(params),
+    }
+
+
+class MetadataIndex:
+    '''image generation parameters in an SQLite database'''
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute(f'''CREATE TABLE IF NOT EXISTS images (
+            path TEXT PRIMARY KEY,
+            mtime REAL NOT NULL,
+            size INTEGER NOT NULL,
+            {", ".join(f"{column} {column_type}" for column, column_type in COLUMNS.items())},
+            params TEXT
+        )''')
+        self.load()
+
+    def load(self):
+        '''read the index into memory, get() does not touch the database, so it can be used from any thread'''
+        self.entries = {row["path"]: row for row in self.db.execute("SELECT * FROM images")}
+
+    def update(self, filenames) -> int:
+        '''scan new and changed files, forget deleted ones, returns the number of scanned files'''
+        known = {row["path"]: (row["mtime"], row["size"])
+                 for row in self.db.execute("SELECT path, mtime, size FROM images")}
+
+        with self.db:
+            self.db.executemany("DELETE FROM images WHERE path = ?",
+                                ((path,) for path in known if not os.path.exists(path)))
+
+        stats = {}
+        for filename in filenames:
+            path = str(Path(filename).resolve())
+            stat = os.stat(path)
+            if known.get(path) != (stat.st_mtime, stat.st_size):
+                stats[path] = stat
+
+        with ProcessPoolExecutor() as executor:
+            metadata = executor.map(read_metadata, stats, chunksize=16)
+            with self.db:
+                for (path, stat), entry in zip(stats.items(), metadata):
+                    if entry is None:
+                        continue
+                    self.db.execute(f'''INSERT OR REPLACE INTO images
+                        VALUES (:path, :mtime, :size, {", ".join(":" + column for column in COLUMNS)}, :params)''',
+                                    {"path": path, "mtime": stat.st_mtime, "size": stat.st_size, **entry})
+
+        self.load()
+        return len(stats)
+
+    def get(self, filename):
+        '''mime type and parameters of an image, None if it is not in the index or has changed since'''
+        path = str(Path(filename).resolve())
+        row = self.entries.get(path)
+        if row is None:
+            return None
+
+        stat = os.stat(path)
+        if (row["mtime"], row["size"]) != (stat.st_mtime, stat.st_size):
+            return None
+
+        params = json.loads(row["params"])
+        params.update({"height": row["height"], "width": row["width"]})
+        return row["mime_type"], params
+
+    def query(self, condition: str) -> list:
+        '''paths of the images matching an SQL condition, i.e. "model = 'sd_xl_base' ORDER BY seed"'''
+        return [Path(row["path"]) for row in self.db.execute(f"SELECT path FROM images WHERE {condition}")]
+
+
+def main(directory, glob_pattern, index_file):
+    dir_path = Path(directory)
+    if not dir_path.exists():
+        raise ValueError("directory does not exist")
+
+    index = MetadataIndex(index_file)
+    scanned = index.update(dir_path.glob(glob_pattern))
+    print(f"{scanned} files scanned")
+
+
+if __name__ == "__main__":
+    try:
+        main(*sys.argv[1:4])
+    except TypeError as error:
+        print(str(error))
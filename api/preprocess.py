@@ -0,0 +1,162 @@
+'''
+local ControlNet preprocessing, used by webcam.py and vid2vid_ffmpeg.py
+
+computes control maps on the client instead of the backend and sends them with `module: none`,
+leaving the backend GPU to the actual image generation.
+control maps are cached by frame hash, repeated or static frames are only preprocessed once.
+call prefetch() when a frame is read, to compute its control maps while earlier frames are being generated.
+
+add your own preprocessors (i.e. a depth estimator) to PREPROCESSORS,
+keyed by the ControlNet module name they replace:
+
+    def my_depth(image: np.ndarray) -> np.ndarray:
+        ...
+    preprocess.PREPROCESSORS["depth_midas"] = my_depth
+
+Needs opencv-python-headless (or opencv-python) for canny.
+'''
+import base64
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from threading import RLock
+
+import numpy as np
+from PIL import Image
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+# Thresholds used for the canny edge detection
+CANNY_THRESHOLDS = (100, 200)
+
+# Number of control maps to keep in the cache
+CACHE_SIZE = 256
+
+
+def canny(image: np.ndarray) -> np.ndarray:
+    if cv2 is None:
+        raise RuntimeError("local canny preprocessing needs opencv-python-headless")
+    return cv2.Canny(cv2.cvtColor(image, cv2.COLOR_RGB2GRAY), *CANNY_THRESHOLDS)
+
+
+PREPROCESSORS = {
+    "canny": canny,
+}
+
+
+def to_base64(control_map: np.ndarray) -> str:
+    '''encode a control map as base64 PNG, scaling float maps (i.e. depth) to 0..255'''
+    if control_map.dtype != np.uint8:
+        low, high = control_map.min(), control_map.max()
+        control_map = ((control_map - low) / ((high - low) or 1) * 255).astype(np.uint8)
+
+    with Image.fromarray(control_map) as image, BytesIO() as buffer:
+        image.convert("RGB").save(buffer, "PNG")
+        return base64.b64encode(buffer.getvalue()).decode('utf-8')
+
+
+def modules(units: list) -> set:
+    '''modules of ControlNet units that can be preprocessed locally'''
+    return {unit.get("module") for unit in units} & PREPROCESSORS.keys()
+
+
+class ControlMaps:
+    '''computes control maps in a worker pool and caches them by frame hash'''
+
+    def __init__(self, max_workers: int = None, cache_size: int = CACHE_SIZE):
+        self.executor = ThreadPoolExecutor(max_workers)
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        # prefetched control maps not asked for yet, they don't count as cache hits
+        self.prefetched = set()
+        # reentrant, as done callbacks of finished futures run right away in the thread adding them
+        self.lock = RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.executor.shutdown()
+
+    def submit(self, image_bytes: bytes, modules: set, prefetch: bool = False) -> dict:
+        '''futures of the control maps of an encoded image, computing the ones not in the cache yet'''
+        digest = hashlib.blake2b(image_bytes, digest_size=16).digest()
+
+        futures, missing = {}, []
+        with self.lock:
+            for module in modules:
+                key = (module, digest)
+                if key in self.cache:
+                    futures[module] = self.claim(key, prefetch)
+                else:
+                    missing.append(module)
+
+        if not missing:
+            return futures
+
+        # decoded outside the lock, other threads don't have to wait for it
+        with BytesIO(image_bytes) as buffer, Image.open(buffer) as image:
+            frame = np.asarray(image.convert("RGB"))
+
+        with self.lock:
+            for module in missing:
+                key = (module, digest)
+                if key in self.cache:
+                    # another thread got there first
+                    futures[module] = self.claim(key, prefetch)
+                    continue
+
+                # opencv releases the GIL, so several preprocessors (and frames) can run at once
+                future = self.executor.submit(lambda m: to_base64(PREPROCESSORS[m](frame)), module)
+                future.add_done_callback(lambda future, key=key: self.forget_failed(key, future))
+                futures[module] = self.cache[key] = future
+                self.misses += 1
+                if prefetch:
+                    self.prefetched.add(key)
+
+            while len(self.cache) > self.cache_size:
+                self.prefetched.discard(self.cache.popitem(last=False)[0])
+
+        return futures
+
+    def claim(self, key, prefetch: bool):
+        '''cached future of a control map, counting cache hits (call with the lock held)'''
+        self.cache.move_to_end(key)
+        if not prefetch:
+            if key in self.prefetched:
+                self.prefetched.discard(key)
+            else:
+                self.hits += 1
+        return self.cache[key]
+
+    def forget_failed(self, key, future):
+        '''drop a failed control map from the cache, so the next request tries again'''
+        if future.cancelled() or future.exception() is not None:
+            with self.lock:
+                if self.cache.get(key) is future:
+                    del self.cache[key]
+                    self.prefetched.discard(key)
+
+    def get(self, image_bytes: bytes, modules: set) -> dict:
+        '''base64 encoded control maps of an encoded image for the given modules'''
+        return {module: future.result() for module, future in self.submit(image_bytes, modules).items()}
+
+    def prefetch(self, units: list, image_bytes: bytes):
+        '''start computing the control maps of ControlNet units in the background, apply() picks them up'''
+        self.submit(image_bytes, modules(units), prefetch=True)
+
+    def apply(self, units: list, image_bytes: bytes) -> list:
+        '''replace server side preprocessing of ControlNet units with local control maps'''
+        if not modules(units):
+            return units
+
+        control_maps = self.get(image_bytes, modules(units))
+        return [{**unit, "module": "none", "input_image": control_maps[unit["module"]]}
+                if unit.get("module") in control_maps else unit
+                for unit in units]
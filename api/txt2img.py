@@ -2,6 +2,10 @@
 '''
 usage: python3 txt2img.py "a puppy dog"
 get help with: python3 txt2img.py -h
+
+with --upscale, generated images are passed on in memory to a second stage upscaling them,
+both stages run at the same time on their own servers (SERVERS and UPSCALE_SERVERS),
+images failing to upscale are saved as they are, as <index>_lowres.png
 '''
 import argparse
 import asyncio
@@ -16,27 +20,54 @@ from aiohttp import ClientSession, ClientTimeout
 OUTPUT_FOLDER = "."
 SERVERS = ["http://127.0.0.1:7860"]
 
+# Extra request headers, i.e. {"X-User": "alice", "X-Priority": "1"} to queue behind job_service.py
+HEADERS = {}
+
+# Seconds to wait for an answer, None waits forever, i.e. for jobs queued behind others in job_service.py
+READ_TIMEOUT = 600
+
+# Servers for the upscale stage, may overlap with SERVERS
+UPSCALE_SERVERS = ["http://127.0.0.1:7860"]
+
+# Upscale with "extras" (/sdapi/v1/extra-single-image) or "img2img"
+UPSCALE_WITH = "extras"
+
+UPSCALE_PAYLOAD = {
+    "upscaling_resize": 2,
+    "upscaler_1": "R-ESRGAN 4x+",
+}
+
+UPSCALE_IMG2IMG_PAYLOAD = {
+    "denoising_strength": 0.3,
+}
+
+# Number of generated images waiting for the upscale stage, before the first stage has to wait
+UPSCALE_QUEUE_SIZE = 8
+
 JPG_SIG = bytes.fromhex("ff d8 ff")
 PNG_SIG = bytes.fromhex("89 50  4e  47  0d  0a  1a  0a")
 
-session_timeout = ClientTimeout(total=None, sock_connect=10, sock_read=600)
+session_timeout = ClientTimeout(total=None, sock_connect=10, sock_read=READ_TIMEOUT)
 queue = asyncio.Queue()
+upscale_queue = asyncio.Queue(maxsize=UPSCALE_QUEUE_SIZE)
+
+upscale_images = False
+"""set to `True` to pass generated images on to the upscale stage instead of saving them"""
 
 
 async def worker(server_address):
-    async with ClientSession(server_address, timeout=session_timeout) as session:
+    async with ClientSession(server_address, timeout=session_timeout, headers=HEADERS) as session:
         while True:
             # get job id and payload from the queue
             index, payload = await queue.get()
             try:
                 # request image generation, loop over resulting images
                 for base64_image in await txt2img(payload, session):
-                    image_bytes = base64.b64decode(base64_image)
-
-                    # save image to disk
-                    output_filename = await get_filename(image_bytes, index)
-                    async with open(output_filename, 'wb') as fp:
-                        await fp.write(image_bytes)
+                    if upscale_images:
+                        # hand over to the upscale stage, waits if it is too far behind
+                        await upscale_queue.put((index, payload, base64_image))
+                    else:
+                        await save_image(base64_image, index)
 
             except RuntimeError:
                 logging.exception("error generating image")
@@ -46,6 +77,31 @@ async def worker(server_address):
             queue.task_done()
 
 
+async def upscale_worker(server_address):
+    async with ClientSession(server_address, timeout=session_timeout, headers=HEADERS) as session:
+        while True:
+            # get a generated image from the first stage
+            index, payload, base64_image = await upscale_queue.get()
+            upscaled_image = None
+            try:
+                upscaled_image = await upscale(base64_image, payload, session)
+            except RuntimeError:
+                logging.exception("error upscaling image")
+            except Exception:
+                logging.exception("unexpected error")
+
+            try:
+                if upscaled_image is not None:
+                    await save_image(upscaled_image, index)
+                else:
+                    # don't throw away the generated image when upscaling fails
+                    await save_image(base64_image, index, suffix="_lowres")
+            except Exception:
+                logging.exception("error saving image")
+
+            upscale_queue.task_done()
+
+
 async def txt2img(payload: dict, session: ClientSession):
     async with session.post('/sdapi/v1/txt2img', json=payload) as response:
         if not response.ok:
@@ -54,7 +110,40 @@ async def txt2img(payload: dict, session: ClientSession):
     return result['images']
 
 
-async def get_filename(image_bytes: bytes, index: int):
+async def upscale(base64_image: str, payload: dict, session: ClientSession) -> str:
+    if UPSCALE_WITH == "img2img":
+        scale = UPSCALE_PAYLOAD.get("upscaling_resize", 2)
+        img2img_payload = {
+            **payload,
+            **UPSCALE_IMG2IMG_PAYLOAD,
+            "width": int(payload.get("width", 512) * scale),
+            "height": int(payload.get("height", 512) * scale),
+            "init_images": [base64_image],
+        }
+        async with session.post('/sdapi/v1/img2img', json=img2img_payload) as response:
+            if not response.ok:
+                raise RuntimeError("error querying server", response.status, await response.text())
+            result = await response.json()
+        return result['images'][0]
+
+    async with session.post('/sdapi/v1/extra-single-image',
+                            json={**UPSCALE_PAYLOAD, "image": base64_image}) as response:
+        if not response.ok:
+            raise RuntimeError("error querying server", response.status, await response.text())
+        result = await response.json()
+    return result['image']
+
+
+async def save_image(base64_image: str, index: int, suffix: str = ""):
+    image_bytes = base64.b64decode(base64_image)
+
+    # save image to disk
+    output_filename = await get_filename(image_bytes, index, suffix)
+    async with open(output_filename, 'wb') as fp:
+        await fp.write(image_bytes)
+
+
+async def get_filename(image_bytes: bytes, index: int, suffix: str = ""):
     # determine image mime type
     if image_bytes.startswith(JPG_SIG):
         extension = ".jpg"
@@ -65,12 +154,12 @@ async def get_filename(image_bytes: bytes, index: int):
 
     # find a "free" filename
     output_folder = Path(OUTPUT_FOLDER)
-    filename = output_folder / f"{index:08d}{extension}"
+    filename = output_folder / f"{index:08d}{suffix}{extension}"
     if not await ospath.exists(filename):
         return filename
 
     for i in count():
-        filename = output_folder / f"{index:08d}_{i:02d}{extension}"
+        filename = output_folder / f"{index:08d}{suffix}_{i:02d}{extension}"
         if not await ospath.exists(filename):
             return filename
 
@@ -79,9 +168,13 @@ async def run():
     # create worker tasks
     tasks = [asyncio.create_task(worker(server_address))
              for server_address in SERVERS]
+    if upscale_images:
+        tasks += [asyncio.create_task(upscale_worker(server_address))
+                  for server_address in UPSCALE_SERVERS]
 
-    # wait for all files to be processed
+    # wait for all jobs to be processed, by both stages
     await queue.join()
+    await upscale_queue.join()
 
     # shut down workers
     for task in tasks:
@@ -102,12 +195,16 @@ async def main():
     parser.add_argument('--seed', type=int, help="seed")
     parser.add_argument('--cfg', type=int, dest="cfg_scale", help="cfg scale")
     parser.add_argument('--sampler', type=str, dest="sampler_name", help="sampler name")
+    parser.add_argument('-u', '--upscale', action='store_true', help="upscale generated images in a second stage")
 
     # parse command arguments
     args = parser.parse_args()
 
+    global upscale_images
+    upscale_images = vars(args).get('upscale', False)
+
     # build job queue
-    params = {k: v for k, v in vars(args).items() if k != 'count'}
+    params = {k: v for k, v in vars(args).items() if k not in ('count', 'upscale')}
     for i in range(0, args.count):
         queue.put_nowait((i, {**params}))
 
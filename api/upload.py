@@ -0,0 +1,73 @@
+'''
+streaming JSON request bodies, used by img2img.py and interrogate.py
+
+put a FileField into a payload where a base64 encoded file belongs,
+the file is then read and encoded in chunks while the request is sent,
+instead of holding the file, its base64 string and the serialized JSON in memory at once:
+
+    payload = {"image": FileField("image.png"), "model": "clip"}
+    async with session.post('/sdapi/v1/interrogate', **await json_body(payload)) as response:
+        ...
+'''
+import base64
+import json
+import re
+import uuid
+
+from aiofiles import open, ospath
+
+# Bytes read from disk at a time, a multiple of 3 keeps base64 padding out of the chunks
+CHUNK_SIZE = 3 * 64 * 1024
+
+
+class FileField:
+    '''placeholder for a file, base64 encoded into the JSON body while it is sent'''
+
+    def __init__(self, filename, prefix: str = ""):
+        self.filename = filename
+        # goes into the JSON string as is
+        self.prefix = json.dumps(prefix)[1:-1]
+        self.token = uuid.uuid4().hex
+
+
+async def json_body(payload: dict) -> dict:
+    '''keyword arguments for ClientSession.post(), streaming the payload as JSON body'''
+    files = {}
+
+    def default(obj):
+        if isinstance(obj, FileField):
+            files[obj.token] = obj
+            return obj.token
+        raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+    # serialize everything but the files, split where they go
+    text = json.dumps(payload, default=default)
+    parts = re.split('"(' + '|'.join(files) + ')"', text) if files else [text]
+    parts = [files.get(part, part.encode('utf-8')) for part in parts]
+
+    # the length of the encoded files is known upfront, no need for a chunked request
+    length = 0
+    for part in parts:
+        if isinstance(part, FileField):
+            size = await ospath.getsize(part.filename)
+            length += len(part.prefix.encode('utf-8')) + 4 * ((size + 2) // 3) + 2
+        else:
+            length += len(part)
+
+    return {
+        "data": stream_parts(parts),
+        "headers": {"Content-Type": "application/json", "Content-Length": str(length)},
+    }
+
+
+async def stream_parts(parts: list):
+    for part in parts:
+        if not isinstance(part, FileField):
+            yield part
+            continue
+
+        yield b'"' + part.prefix.encode('utf-8')
+        async with open(part.filename, mode='rb') as fp:
+            while chunk := await fp.read(CHUNK_SIZE):
+                yield base64.b64encode(chunk)
+        yield b'"'
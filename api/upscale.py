@@ -0,0 +1,176 @@
+"""
+usage: python3 upscale.py <directory> <glob pattern>
+i.e.: python3 upscale.py images **/*.png
+
+puts out <original_filename>_upscaled.png next to the original file
+
+sends the images in batches to the extras API (/sdapi/v1/extra-batch-images),
+as many as fit into the pixel budget of the server, derived from its free memory (/sdapi/v1/memory)
+
+add more servers to SERVERS to process stuff in parallel
+add to or change PAYLOAD to change upscaling parameters
+"""
+import asyncio
+import base64
+import logging
+import sys
+from pathlib import Path
+
+from aiofiles import open, ospath
+from aiohttp import ClientSession, ClientTimeout
+from PIL import Image
+from upload import FileField, json_body
+
+SERVERS = ["http://127.0.0.1:7860"]
+
+# Extra request headers, i.e. {"X-User": "alice", "X-Priority": "1"} to queue behind job_service.py
+HEADERS = {}
+
+# Seconds to wait for an answer, None waits forever, i.e. for jobs queued behind others in job_service.py
+READ_TIMEOUT = 600
+
+PAYLOAD = {
+    "upscaling_resize": 2,
+    "upscaler_1": "R-ESRGAN 4x+",
+}
+
+# Upper limit of upscaled pixels in one batch, lower it for servers with little memory
+MAX_BATCH_PIXELS = 32 * 1024 * 1024
+
+# Per server overrides of the pixel budget, e.g. {"http://127.0.0.1:7861": 8 * 1024 * 1024}
+# servers not listed here are asked for their free memory
+SERVER_BATCH_PIXELS = {}
+
+# Rough memory use of the server per upscaled pixel in a batch, to turn its free memory into a pixel budget
+BYTES_PER_PIXEL = 64
+
+# Upper limit of images in one batch
+MAX_BATCH_SIZE = 16
+
+session_timeout = ClientTimeout(total=None, sock_connect=10, sock_read=READ_TIMEOUT)
+queue: asyncio.Queue[tuple] = asyncio.Queue()
+
+
+async def worker(server_address):
+    """one of these guys is run for each SERVERS entry"""
+    # a file that did not fit into the last batch, it starts the next one
+    carry = None
+
+    async with ClientSession(server_address, timeout=session_timeout, headers=HEADERS) as session:
+        max_pixels = SERVER_BATCH_PIXELS.get(server_address) or await get_batch_pixels(session)
+        while True:
+            # get as many files from the queue as fit into one batch
+            batch = [carry or await queue.get()]
+            carry = None
+            pixels = batch[0][1]
+            while len(batch) < MAX_BATCH_SIZE and not queue.empty():
+                job = queue.get_nowait()
+                if pixels + job[1] > max_pixels:
+                    carry = job
+                    break
+                batch.append(job)
+                pixels += job[1]
+
+            try:
+                await process_batch([filename for filename, _ in batch], session)
+            except RuntimeError:
+                logging.exception("error upscaling files: %s", [filename for filename, _ in batch])
+            except Exception:
+                logging.exception("unexpected error")
+
+            for _ in batch:
+                queue.task_done()
+
+
+async def process_batch(filenames: list, session: ClientSession):
+    # determine the output filenames
+    # attention: the API does return the file type set in the backend options
+    #   see txt2img.py for one approach of handling this situation
+    output_filenames = [filename.with_stem(filename.stem + "_upscaled").with_suffix(".png")
+                        for filename in filenames]
+    for output_filename in output_filenames:
+        if await ospath.exists(output_filename):
+            raise ValueError("file already exists", output_filename)
+
+    # call the extras API
+    images = await extra_batch_images(get_payload(filenames), session)
+    if len(images) != len(filenames):
+        raise RuntimeError("unexpected number of images", len(images), len(filenames))
+
+    # split the batch up again and save the outputs to disk
+    for output_filename, base64_image in zip(output_filenames, images):
+        async with open(output_filename, "wb") as fp:
+            await fp.write(base64.b64decode(base64_image))
+
+
+async def extra_batch_images(payload: dict, session: ClientSession):
+    async with session.post("/sdapi/v1/extra-batch-images", **await json_body(payload)) as response:
+        if not response.ok:
+            raise RuntimeError("error querying server", response.status, await response.text())
+        result = await response.json()
+    return result["images"]
+
+
+async def get_batch_pixels(session: ClientSession) -> int:
+    """pixel budget of a server from its free memory, MAX_BATCH_PIXELS if it can't tell"""
+    try:
+        async with session.get("/sdapi/v1/memory") as response:
+            memory = await response.json()
+        free = [memory["ram"]["free"]]
+        if "system" in memory.get("cuda", {}):
+            free.append(memory["cuda"]["system"]["free"])
+    except Exception:
+        logging.warning("could not query the free memory of the server, using MAX_BATCH_PIXELS")
+        return MAX_BATCH_PIXELS
+
+    return min(int(min(free) / BYTES_PER_PIXEL), MAX_BATCH_PIXELS)
+
+
+def get_payload(filenames: list, custom_payload=PAYLOAD):
+    """build a payload from the given images and a custom payload"""
+    return {
+        **custom_payload,
+        # the images are read and base64 encoded while the request is sent
+        "imageList": [{"data": FileField(filename), "name": filename.name} for filename in filenames],
+    }
+
+
+def get_upscaled_pixels(image_filename: Path) -> int:
+    """number of pixels of the upscaled image, PIL only needs the file header for that"""
+    with Image.open(image_filename) as image:
+        return int(image.width * image.height * PAYLOAD.get("upscaling_resize", 2) ** 2)
+
+
+async def run():
+    # create worker tasks
+    tasks = [asyncio.create_task(worker(server_address)) for server_address in SERVERS]
+
+    # wait for all files to be processed
+    await queue.join()
+
+    # shut down workers
+    for task in tasks:
+        task.cancel()
+
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def main(directory, glob_pattern):
+    dir_path = Path(directory)
+    if not dir_path.exists():
+        raise ValueError("directory does not exist")
+
+    for filename in dir_path.glob(glob_pattern):
+        try:
+            queue.put_nowait((filename, get_upscaled_pixels(filename)))
+        except Exception:
+            logging.exception("error reading file: %s", filename)
+
+    await run()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main(*sys.argv[1:3]))
+    except TypeError as error:
+        print(str(error))
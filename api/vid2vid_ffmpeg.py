@@ -3,21 +3,43 @@ usage: python3 vid2vid_ffmpeg.py input.mp4 output.mp4
 
 add to or change PAYLOAD to change image generation parameters
 
-a call for TemporalNet is prepared below (line 80+), uncomment if needed
+set KEYFRAME_INTERVAL and add more servers to SERVERS to process the video in parallel,
+keyframes first, the frames in between conditioned on their keyframe
 
+set LOCAL_PREPROCESSING to compute ControlNet control maps on the client (needs preprocess.py next to it)
+
+a call for TemporalNet is prepared in controlnet_units() below, uncomment if needed
+
+set FRAME_STORE to keep generated frames on disk (needs frame_store.py next to it):
+an interrupted run then only generates the missing frames when started again,
+and a finished one can be re-encoded without calling the backend
 '''
 import base64
 import contextlib
+import os
 import sys
+from collections import deque
+from concurrent.futures import Future
 from io import BytesIO
+from itertools import chain, count
+from queue import PriorityQueue, Queue
+from threading import Thread
 
 import ffmpeg
 import numpy as np
 import requests
+from frame_store import FrameStore
 from PIL import Image
+from preprocess import ControlMaps
 
 URL = "http://127.0.0.1:7860"
 
+# Servers used to process keyframe chains in parallel, see KEYFRAME_INTERVAL
+SERVERS = [URL]
+
+# Extra request headers, i.e. {"X-User": "alice", "X-Priority": "1"} to queue behind job_service.py
+HEADERS = {}
+
 PAYLOAD = {
     "prompt": "a cute puppy dog",
     "steps": 15,
@@ -25,6 +47,32 @@ PAYLOAD = {
     'seed': 123,
 }
 
+# Decode generated images once and pipe raw rgb24 frames to ffmpeg,
+# instead of making ffmpeg decode every PNG/JPEG again.
+RAW_FRAMES = True
+
+# Number of frames the writer thread may buffer before generation has to wait
+FRAME_BUFFER_SIZE = 16
+
+# Split the video into chains of this many frames, each starting with a keyframe.
+# Keyframes are generated first, in parallel on all SERVERS, then the frames of each chain one after another,
+# each conditioned on its keyframe and the frame before it (see controlnet_units()).
+# None processes the whole video as a single chain on URL.
+KEYFRAME_INTERVAL = None
+
+# Weight of the keyframe as reference (ControlNet reference_only) for the frames of its chain, 0 to disable
+KEYFRAME_REFERENCE_WEIGHT = 0.5
+
+# Compute ControlNet control maps (i.e. canny) on the client instead of the backend,
+# see preprocess.py for the available preprocessors
+LOCAL_PREPROCESSING = False
+
+# Number of frames read ahead to compute their control maps while earlier frames are being generated
+PREPROCESS_AHEAD = 4
+
+# Directory to keep generated frames in, e.g. "output_frames"
+FRAME_STORE = None
+
 FFMPEG_OUTPUT_PARAMS = {
     'vcodec': 'libx264',
     'crf': 23
@@ -53,18 +101,42 @@ FFMPEG_FILTERS = {
     # }
 }
 
+control_maps = ControlMaps()
 
-def img2img(frame: bytes, payload_base: dict, context: dict) -> bytes:
+
+def img2img(frame: bytes, payload_base: dict, context: dict, url: str = URL) -> bytes:
     base64_frame = base64.b64encode(frame).decode('utf-8')
 
     # assemble payload
     payload = {
         **payload_base,
+        "alwayson_scripts": {**payload_base["alwayson_scripts"]},
         "init_images": [base64_frame]
     }
 
     # add controlnets
-    payload["alwayson_scripts"]["controlnet"] = {"args": [
+    payload["alwayson_scripts"]["controlnet"] = {"args": controlnet_units(base64_frame, context)}
+
+    # replace server side preprocessing with control maps computed locally
+    if LOCAL_PREPROCESSING:
+        controlnet = payload["alwayson_scripts"]["controlnet"]
+        controlnet["args"] = control_maps.apply(controlnet["args"], frame)
+
+    # call img2img API
+    response = requests.post(f'{url}/sdapi/v1/img2img', json=payload, headers=HEADERS)
+    if not response.ok:
+        raise RuntimeError("post request failed")
+
+    base64_image = response.json()['images'][0]
+    context['last_source_image'] = base64_frame
+    context['last_generated'] = base64_image
+
+    return base64.b64decode(base64_image)
+
+
+def controlnet_units(base64_frame: str, context: dict) -> list:
+    '''ControlNet units for a frame, edit these to change the ControlNets used'''
+    units = [
         # {
         #    "module": "reference_only",
         #    "input_image": base64_frame
@@ -75,12 +147,21 @@ def img2img(frame: bytes, payload_base: dict, context: dict) -> bytes:
             "control_mode": 2,
             "input_image": base64_frame,
         }
-    ]}
+    ]
+
+    # keep the frames of a keyframe chain close to their keyframe
+    keyframe = context.get('keyframe')
+    if keyframe is not None and KEYFRAME_REFERENCE_WEIGHT:
+        units.append({
+            "module": "reference_only",
+            "input_image": keyframe,
+            "weight": KEYFRAME_REFERENCE_WEIGHT,
+        })
 
     # add temporalnet if we have a previous image
     # last_generated = context.get('last_generated')
     # if last_generated is not None:
-    #     payload["alwayson_scripts"]["controlnet"]["args"].append({
+    #     units.append({
     #         "input_image": last_generated,
     #         "model": "diff_control_sd15_temporalnet_fp16 [adc6bd97]",
     #         "module": "none",
@@ -88,23 +169,118 @@ def img2img(frame: bytes, payload_base: dict, context: dict) -> bytes:
     #         "guidance": 1,
     #     })
 
-    # call img2img API
-    response = requests.post(f'{URL}/sdapi/v1/img2img', json=payload)
-    if not response.ok:
-        raise RuntimeError("post request failed")
+    return units
+
+
+def preprocess_ahead(frames, store: FrameStore = None):
+    '''read frames ahead, to compute their control maps while earlier frames are being generated'''
+    pending = deque()
+    for index, frame in enumerate(frames):
+        if store is None or index not in store:
+            # only the modules of the units matter here
+            control_maps.prefetch(controlnet_units(None, {}), frame)
+        pending.append(frame)
+        if len(pending) > PREPROCESS_AHEAD:
+            yield pending.popleft()
+
+    yield from pending
+
+
+def get_frame(index: int, frame: bytes, payload_base: dict, context: dict,
+              store: FrameStore = None, url: str = URL) -> bytes:
+    '''get a generated frame from the store or process it with the img2img API'''
+    if store is not None and index in store:
+        image = store.read(index)
+        # keep the TemporalNet chain going
+        context['last_generated'] = base64.b64encode(image).decode('utf-8')
+        return image
+
+    image = img2img(frame, payload_base, context, url)
+    if store is not None:
+        store.write(index, image)
+    return image
+
+
+def keyframe_chains(frames, payload_base: dict, store: FrameStore = None):
+    '''generate frames in chains of KEYFRAME_INTERVAL frames, spread over all SERVERS
+
+    the keyframes (first frame of each chain) of the frames read ahead are generated first, in parallel on all servers.
+    once its keyframe is done, the rest of a chain follows on one server, frame after frame,
+    each frame conditioned on the keyframe and the frame before it (see controlnet_units())
+    '''
+    # (priority, order, job), keyframes go first
+    jobs = PriorityQueue()
+    order = count()
+
+    def submit(priority: int, job):
+        jobs.put((priority, next(order), job))
+
+    def work(url: str):
+        # one of these guys is run for each SERVERS entry
+        while (job := jobs.get()[2]) is not None:
+            job(url)
+
+    def start_chain(start: int, frames: list) -> Future:
+        result = Future()
+
+        def keyframe(url: str):
+            context = {}
+            try:
+                image = get_frame(start, frames[0], payload_base, context, store, url)
+            except Exception as error:
+                result.set_exception(error)
+                return
+            context['keyframe'] = base64.b64encode(image).decode('utf-8')
+            submit(1, lambda url: following_frames(url, context, image))
+
+        def following_frames(url: str, context: dict, keyframe_image: bytes):
+            try:
+                images = [get_frame(start + i, frame, payload_base, context, store, url)
+                          for i, frame in enumerate(frames[1:], 1)]
+            except Exception as error:
+                result.set_exception(error)
+                return
+            result.set_result([keyframe_image] + images)
+
+        submit(0, keyframe)
+        return result
+
+    workers = [Thread(target=work, args=(url,), daemon=True) for url in SERVERS]
+    for worker in workers:
+        worker.start()
 
-    base64_image = response.json()['images'][0]
-    context['last_source_image'] = base64_frame
-    context['last_generated'] = base64_image
+    try:
+        pending = deque()
+        chain_frames = []
+        for index, frame in enumerate(frames):
+            chain_frames.append(frame)
+            if len(chain_frames) < KEYFRAME_INTERVAL:
+                continue
 
-    return base64.b64decode(base64_image)
+            pending.append(start_chain(index + 1 - len(chain_frames), chain_frames))
+            chain_frames = []
+
+            # keep every server busy, but don't read ahead too far
+            if len(pending) > 2 * len(SERVERS):
+                yield from pending.popleft().result()
+
+        if chain_frames:
+            pending.append(start_chain(index + 1 - len(chain_frames), chain_frames))
 
+        while pending:
+            yield from pending.popleft().result()
 
-def read_frames(input_file, r_frames, width, height):
+    finally:
+        # shut down workers, once they are done with what is queued
+        for _ in workers:
+            submit(2, None)
+
+
+def read_frames(input_file, r_frames, width, height, **input_params):
     input_process = (
         ffmpeg
-        .input(input_file, loglevel='quiet')
-        .output('pipe:', format='rawvideo', pix_fmt='rgb24', r=r_frames)
+        .input(input_file, loglevel='quiet', **input_params)
+        .output('pipe:', format='rawvideo', pix_fmt='rgb24', r=r_frames, s=f'{width}x{height}')
         .run_async(pipe_stdout=True)
     )
 
@@ -125,9 +301,77 @@ def read_frames(input_file, r_frames, width, height):
         input_process.wait()
 
 
+class FrameWriter(Thread):
+    '''writes frames to the stdin of an ffmpeg process from a bounded buffer'''
+
+    def __init__(self, ffmpeg_process, buffer_size: int = FRAME_BUFFER_SIZE, frame_size: tuple = None):
+        super().__init__(daemon=True)
+        self.ffmpeg_process = ffmpeg_process
+        # (width, height) of raw frames, None for encoded images
+        self.frame_size = frame_size
+        self.frames = Queue(maxsize=buffer_size)
+        self.error = None
+
+    def run(self):
+        while (frame := self.frames.get()) is not None:
+            if self.error is not None:
+                # ffmpeg is gone, just keep the buffer from filling up
+                continue
+            try:
+                # bytes and ndarrays both support the buffer protocol, no copies needed
+                self.ffmpeg_process.stdin.write(frame)
+            except Exception as error:
+                self.error = error
+
+    def fit(self, frame):
+        '''resize raw frames not matching the frame size, ffmpeg would misread them and all following frames'''
+        if self.frame_size is None or (frame.shape[1], frame.shape[0]) == self.frame_size:
+            return frame
+        with Image.fromarray(frame) as image:
+            return np.asarray(image.resize(self.frame_size))
+
+    def write(self, frame):
+        '''queue a frame, blocks while the buffer is full'''
+        if self.error is not None:
+            raise RuntimeError("error writing to ffmpeg") from self.error
+        self.frames.put(self.fit(frame))
+
+    def close(self):
+        '''write out all buffered frames and close the ffmpeg input, raises if ffmpeg did not finish cleanly'''
+        self.frames.put(None)
+        self.join()
+        try:
+            self.ffmpeg_process.stdin.close()
+        except Exception as error:
+            self.error = self.error or error
+        finally:
+            self.ffmpeg_process.wait()
+
+        if self.error is not None:
+            raise RuntimeError("error writing to ffmpeg") from self.error
+        if self.ffmpeg_process.returncode != 0:
+            raise RuntimeError("ffmpeg failed", self.ffmpeg_process.returncode)
+
+
+def decode_frame(image_bytes: bytes) -> np.ndarray:
+    '''decode a PNG/JPEG image to a raw rgb24 frame'''
+    with BytesIO(image_bytes) as buffer, Image.open(buffer) as image:
+        return np.asarray(image.convert("RGB"))
+
+
+def pipe_input(frame_size: tuple = None, **input_params):
+    '''ffmpeg input reading from stdin; raw rgb24 frames if a frame size (width, height) is given'''
+    if frame_size is None:
+        return ffmpeg.input('pipe:', format='image2pipe', **input_params)
+
+    width, height = frame_size
+    return ffmpeg.input('pipe:', format='rawvideo', pix_fmt='rgb24', s=f'{width}x{height}', **input_params)
+
+
 @contextlib.contextmanager
-def prepare_output(output_file: str, frame_rate):
-    frames_input = ffmpeg.input('pipe:', format='image2pipe', framerate=frame_rate)
+def prepare_output(output_file: str, frame_rate, frame_size: tuple = None, output_params: dict = None,
+                   buffer_size: int = FRAME_BUFFER_SIZE):
+    frames_input = pipe_input(frame_size, framerate=frame_rate)
 
     # filters
     for name, params in FFMPEG_FILTERS.items():
@@ -135,15 +379,16 @@ def prepare_output(output_file: str, frame_rate):
 
     ffmpeg_process = (
         frames_input
-        .output(output_file, **FFMPEG_OUTPUT_PARAMS)
+        .output(output_file, **(output_params or FFMPEG_OUTPUT_PARAMS))
         .run_async(pipe_stdin=True)
     )
 
+    writer = FrameWriter(ffmpeg_process, buffer_size, frame_size)
+    writer.start()
     try:
-        yield ffmpeg_process
+        yield writer
     finally:
-        ffmpeg_process.stdin.close()
-        ffmpeg_process.wait()
+        writer.close()
 
 
 def probe(filename: str):
@@ -161,10 +406,37 @@ def main(input_file: str, output_file: str):
         **PAYLOAD
     }
 
-    img2img_context = {}
-    with prepare_output(output_file, r_frames) as output:
-        for frame in read_frames(input_file, r_frames, width, height):
-            output.stdin.write(img2img(frame, payload_base, img2img_context))
+    store = None
+    if FRAME_STORE is not None:
+        stat = os.stat(input_file)
+        source = {"input": os.path.abspath(input_file), "size": stat.st_size, "mtime": stat.st_mtime,
+                  "frame_rate": r_frames, "payload": PAYLOAD}
+        store = FrameStore(FRAME_STORE, source)
+
+    frames = read_frames(input_file, r_frames, width, height)
+    if LOCAL_PREPROCESSING:
+        frames = preprocess_ahead(frames, store)
+    if KEYFRAME_INTERVAL:
+        images = keyframe_chains(frames, payload_base, store)
+    else:
+        img2img_context = {}
+        images = (get_frame(index, frame, payload_base, img2img_context, store)
+                  for index, frame in enumerate(frames))
+    if RAW_FRAMES:
+        images = map(decode_frame, images)
+
+    # the output frame size is only known for sure once the first image is back
+    first_image = next(images, None)
+    if first_image is None:
+        return
+    frame_size = (first_image.shape[1], first_image.shape[0]) if RAW_FRAMES else None
+
+    with prepare_output(output_file, r_frames, frame_size) as output:
+        for image in chain([first_image], images):
+            output.write(image)
+
+    if LOCAL_PREPROCESSING:
+        print(f"control maps: {control_maps.misses} computed, {control_maps.hits} from cache")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,245 @@
+'''
+usage: python3 vid2vid_stream.py <input> <output playlist>
+i.e.: python3 vid2vid_stream.py rtsp://192.168.0.10/stream live/stream.m3u8
+
+processes a continuous video source (stream url, growing file, pipe) using the Img2Img API,
+writes rolling HLS segments of the result
+
+for a pipe (i.e. "pipe:" for stdin, or a named pipe), set FRAME_SIZE, probing the input would consume its start
+for a file still being written, set FOLLOW_INPUT
+i.e.: some_capture | python3 vid2vid_stream.py pipe: live/stream.m3u8
+
+frames are processed in a small window: when the backends fall behind, the oldest waiting frames are dropped
+and the last generated frame is repeated, keeping the latency bounded instead of falling further behind
+
+set REALTIME_INPUT to play back a local video file in real time for testing:
+i.e.: python3 vid2vid_stream.py input.mp4 live/stream.m3u8
+
+generation parameters (PAYLOAD, LOCAL_PREPROCESSING, TemporalNet...) are taken from vid2vid_ffmpeg.py
+
+Needs vid2vid_ffmpeg.py next to it.
+Needs ffmpeg.
+'''
+import statistics
+import sys
+import time
+from collections import deque
+from io import BytesIO
+from pathlib import Path
+from queue import Empty, Queue
+from threading import Condition, Thread
+
+import numpy as np
+import vid2vid_ffmpeg
+from PIL import Image
+
+SERVERS = ["http://127.0.0.1:7860"]
+
+# Frames per second taken from the input and written to the output
+FRAME_RATE = 8
+
+# Number of input frames waiting to be processed, older ones are dropped
+WINDOW_SIZE = 4
+
+# Read the input at its native frame rate (ffmpeg -re), for playing back local files
+REALTIME_INPUT = False
+
+# Size the input frames are scaled to, e.g. (512, 512), needed for pipes. None probes the input for it
+FRAME_SIZE = None
+
+# Keep reading at the end of a growing input file, waiting for more data (ffmpeg file protocol -follow 1)
+FOLLOW_INPUT = False
+
+# Seconds between latency reports
+STATS_INTERVAL = 5
+
+# Frames buffered before the encoder, each one adds 1 / FRAME_RATE to the latency
+WRITER_BUFFER_SIZE = 2
+
+FFMPEG_OUTPUT_PARAMS = {
+    'format': 'hls',
+    'hls_time': 2,
+    'hls_list_size': 6,
+    'hls_flags': 'delete_segments+independent_segments',
+    # for fragmented mp4 instead, use an .mp4 output file and
+    # 'movflags': 'frag_keyframe+empty_moov+default_base_moof',
+    'vcodec': 'libx264',
+    'preset': 'veryfast',
+    'tune': 'zerolatency',
+    'pix_fmt': 'yuv420p',
+    # a keyframe at every segment start
+    'g': FRAME_RATE * 2,
+}
+
+
+class LatencyStats:
+    '''latency from reading a frame to handing it to the encoder, and frame counts
+
+    viewers see more than that: the writer buffer, the encoder and the HLS segment duration come on top
+    '''
+
+    def __init__(self):
+        self.latencies = []
+        self.generated = 0
+        self.dropped = 0
+        self.late = 0
+        self.reused = 0
+
+    def report(self):
+        if self.latencies:
+            latencies = sorted(self.latencies)
+            p95 = latencies[int(len(latencies) * 0.95)]
+            print(f"read -> encoder latency avg {statistics.fmean(latencies):.2f}s, p95 {p95:.2f}s, "
+                  f"max {latencies[-1]:.2f}s (+ {WRITER_BUFFER_SIZE / FRAME_RATE:.2f}s buffer, "
+                  f"+ up to {FFMPEG_OUTPUT_PARAMS.get('hls_time', 0)}s segment for viewers) | "
+                  f"generated: {self.generated}, dropped: {self.dropped}, late: {self.late}, reused: {self.reused}")
+        self.latencies.clear()
+
+
+class FrameWindow:
+    '''fixed-size window of input frames waiting to be processed, dropping the oldest ones when full'''
+
+    def __init__(self, size: int, stats: LatencyStats):
+        self.frames = deque()
+        self.size = size
+        self.stats = stats
+        self.closed = False
+        self.condition = Condition()
+
+    def put(self, frame):
+        with self.condition:
+            if len(self.frames) >= self.size:
+                self.frames.popleft()
+                self.stats.dropped += 1
+            self.frames.append(frame)
+            self.condition.notify()
+
+    def get(self):
+        '''oldest frame in the window, None when the input has ended'''
+        with self.condition:
+            while not self.frames and not self.closed:
+                self.condition.wait()
+            return self.frames.popleft() if self.frames else None
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+def reader(input_source, width: int, height: int, window: FrameWindow):
+    '''read frames from the input as they come, tagged with a sequence number and the time they were read'''
+    input_params = {'re': None} if REALTIME_INPUT else {}
+    if FOLLOW_INPUT:
+        input_params['follow'] = 1
+    try:
+        frames = vid2vid_ffmpeg.read_frames(input_source, FRAME_RATE, width, height, **input_params)
+        for seq, frame in enumerate(frames):
+            if vid2vid_ffmpeg.LOCAL_PREPROCESSING:
+                # computed while the frame waits in the window
+                vid2vid_ffmpeg.control_maps.prefetch(vid2vid_ffmpeg.controlnet_units(None, {}), frame)
+            window.put((seq, time.monotonic(), frame))
+    finally:
+        window.close()
+
+
+def worker(server_address, payload_base: dict, window: FrameWindow, results: Queue):
+    '''one of these guys is run for each SERVERS entry'''
+    width, height = payload_base['width'], payload_base['height']
+    # every worker keeps its own TemporalNet chain
+    context = {}
+    while (item := window.get()) is not None:
+        seq, read_time, frame = item
+        try:
+            image_bytes = vid2vid_ffmpeg.img2img(frame, payload_base, context, server_address)
+        except Exception as error:
+            print(f"error processing frame {seq}: {error}")
+            continue
+
+        with BytesIO(image_bytes) as buffer, Image.open(buffer) as image:
+            # the output stream needs all frames in the same size
+            image = image.convert("RGB")
+            if image.size != (width, height):
+                image = image.resize((width, height))
+            results.put((seq, read_time, np.asarray(image)))
+
+
+def is_pipe(input_source: str) -> bool:
+    return input_source == '-' or input_source.startswith('pipe:') or Path(input_source).is_fifo()
+
+
+def main(input_source: str, output_file: str):
+    if FRAME_SIZE is not None:
+        width, height = FRAME_SIZE
+    elif is_pipe(input_source):
+        raise ValueError("set FRAME_SIZE for pipe input, probing would consume it")
+    else:
+        width, height, _ = vid2vid_ffmpeg.probe(input_source)
+    payload_base = {
+        'width': width,
+        'height': height,
+        'alwayson_scripts': {},
+        **vid2vid_ffmpeg.PAYLOAD
+    }
+
+    Path(output_file).parent.mkdir(parents=True, exist_ok=True)
+
+    stats = LatencyStats()
+    window = FrameWindow(WINDOW_SIZE, stats)
+    results = Queue()
+
+    Thread(target=reader, args=(input_source, width, height, window), daemon=True).start()
+    workers = [Thread(target=worker, args=(server_address, payload_base, window, results), daemon=True)
+               for server_address in SERVERS]
+    for thread in workers:
+        thread.start()
+
+    with vid2vid_ffmpeg.prepare_output(output_file, FRAME_RATE, (width, height), FFMPEG_OUTPUT_PARAMS,
+                                       WRITER_BUFFER_SIZE) as output:
+        last_image, last_seq = None, -1
+        next_frame = next_report = time.monotonic()
+
+        while any(thread.is_alive() for thread in workers) or not results.empty():
+            # take the newest generated frame, results overtaken by newer ones are late,
+            # newer ones finished within the same tick are dropped
+            newest = None
+            while True:
+                try:
+                    result = results.get_nowait()
+                except Empty:
+                    break
+                if result[0] < last_seq:
+                    stats.late += 1
+                    continue
+                if newest is not None:
+                    stats.dropped += 1
+                newest = result
+                last_seq = result[0]
+
+            # write one frame per tick, repeat the last one if nothing new is ready
+            if newest is not None:
+                _, read_time, last_image = newest
+                stats.generated += 1
+            elif last_image is not None:
+                stats.reused += 1
+            if last_image is not None:
+                output.write(last_image)
+                if newest is not None:
+                    stats.latencies.append(time.monotonic() - read_time)
+
+            now = time.monotonic()
+            if now >= next_report:
+                stats.report()
+                next_report = now + STATS_INTERVAL
+
+            next_frame += 1 / FRAME_RATE
+            time.sleep(max(0, next_frame - time.monotonic()))
+
+    stats.report()
+
+
+if __name__ == "__main__":
+    try:
+        main(*sys.argv[1:3])
+    except TypeError as error:
+        print(str(error))
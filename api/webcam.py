@@ -1,5 +1,7 @@
 '''
 usage: python3 webcam.py
+
+set LOCAL_PREPROCESSING to compute ControlNet control maps on the client (needs preprocess.py next to it)
 '''
 import base64
 from io import BytesIO
@@ -8,6 +10,7 @@ from threading import Thread
 import pygame.camera
 import pygame.image
 import requests
+from preprocess import ControlMaps
 
 URL = "http://127.0.0.1:7860"
 
@@ -20,6 +23,11 @@ PAYLOAD = {
 # Set to True to send frames to the img2img api
 DO_IMG2IMG = False
 
+# Compute ControlNet control maps on the client instead of the backend.
+# canny is built in, add a depth estimator to preprocess.PREPROCESSORS["depth_midas"]
+# to do the depth map locally as well.
+LOCAL_PREPROCESSING = False
+
 # Save img2img frames to disk
 SAVE_FRAMES = False
 
@@ -34,11 +42,11 @@ CAMERA_RESOLUTION = (640, 480)
 CAMERA_CROP = None
 
 
-def to_base64(frame):
-    # convert frame surface to base64 encoded PNG
+def to_png(frame) -> bytes:
+    # convert frame surface to PNG
     with BytesIO() as buffer:
         pygame.image.save(frame, buffer, "img.png")
-        return base64.b64encode(buffer.getvalue()).decode('utf-8')
+        return buffer.getvalue()
 
 
 def from_base64(base64_image, frame_no: int, save_to_disk: bool = False):
@@ -53,6 +61,7 @@ class Game:
     run = True
     crop = None
     frame_no = 0
+    control_maps = ControlMaps()
 
     @property
     def width(self):
@@ -122,7 +131,8 @@ class Game:
             pygame.display.flip()
 
     def img2img(self, frame: pygame.Surface):
-        base64_image = to_base64(frame)
+        image_bytes = to_png(frame)
+        base64_image = base64.b64encode(image_bytes).decode('utf-8')
 
         # assemble payload
         payload = {
@@ -150,6 +160,11 @@ class Game:
             }
         }
 
+        # replace server side preprocessing with control maps computed locally
+        if LOCAL_PREPROCESSING:
+            controlnet = payload['alwayson_scripts']['controlnet']
+            controlnet['args'] = self.control_maps.apply(controlnet['args'], image_bytes)
+
         # call img2img API
         response = requests.post(f'{URL}/sdapi/v1/img2img', json=payload)
         if not response.ok: